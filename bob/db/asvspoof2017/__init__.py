@@ -8,8 +8,36 @@ The ASVspoof2017 Database access methods for Bob
 
 """
 
-from .query import Database
-from .models import Client, File, Protocol, ProtocolFiles
+# the database and model classes are only imported (together with SQLAlchemy)
+# when first accessed, so that importing this package stays cheap
+_lazy = {
+    'Database': 'query',
+    'Client': 'models',
+    'ClientRecord': 'models',
+    'File': 'models',
+    'FileRecord': 'models',
+    'Protocol': 'models',
+    'ProtocolRecord': 'models',
+    'ProtocolFiles': 'models',
+    'Source': 'models',
+    'PackedAudio': 'pack',
+    'FeatureStore': 'featurestore',
+    'AsyncDatabase': 'asyncdb',
+    'BalancedSampler': 'sampler',
+}
+
+
+def __getattr__(name):
+    if name not in _lazy:
+        raise AttributeError("module %r has no attribute %r" % (__name__, name))
+    import importlib
+    value = getattr(importlib.import_module('.' + _lazy[name], __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_lazy))
 
 
 def get_config():
@@ -22,4 +50,4 @@ def get_config():
 
 
 # gets sphinx autodoc done right - don't remove it
-__all__ = [_ for _ in dir() if not _.startswith('_')]
+__all__ = sorted(list(_lazy) + ['get_config'])
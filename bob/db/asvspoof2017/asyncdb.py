@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""An :py:mod:`asyncio` front-end to the ASVspoof2017 database.
+
+Every query of :py:class:`.Database` blocks on SQLite, and loading audio blocks
+on file reads. :py:class:`AsyncDatabase` runs them on a bounded pool of
+threads, each with its own database session, so that an event loop never
+waits for them.
+"""
+
+import asyncio
+import weakref
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+
+
+class AsyncDatabase(object):
+    """Answers the queries of a :py:class:`.Database` as coroutines
+
+    Keyword parameters:
+
+    max_workers
+        The number of threads running queries and reading files.
+
+    max_concurrency
+        The maximum number of calls running (or waiting for a thread) at a
+        time. Further calls wait in the event loop. Defaults to twice
+        ``max_workers``.
+
+    kwargs
+        Passed to :py:class:`.Database`, which is opened with
+        ``process_safe=True``, so that each thread uses its own session.
+
+    The database should be closed with :py:meth:`AsyncDatabase.close`, or used
+    as an asynchronous context manager::
+
+        async with AsyncDatabase() as db:
+            files = await db.objects(groups='dev')
+            audio = await db.load_audio(files, directory)
+            async for f in db.iter_objects(groups='eval'):
+                ...
+
+    The returned :py:class:`.File` objects are bound to the session of the
+    thread which loaded them: prefer :py:meth:`AsyncDatabase.records` when the
+    results are used across threads. The database should be used from one event
+    loop at a time.
+    """
+
+    def __init__(self, max_workers=8, max_concurrency=None, **kwargs):
+        from .query import Database
+
+        kwargs['process_safe'] = True
+        self.database = Database(**kwargs)
+        self.m_executor = ThreadPoolExecutor(max_workers=max(1, max_workers))
+        self.m_concurrency = max_concurrency or 2 * max(1, max_workers)
+        self.m_semaphore = None
+        self.m_loop = None  # a weak reference to the loop of the semaphore
+
+    async def _run(self, function, *args, **kwargs):
+        """Runs ``function(*args, **kwargs)`` on the executor, within the
+        concurrency limit"""
+
+        return await self._run_on(self.m_executor, lambda: function(*args, **kwargs))
+
+    async def _run_on(self, executor, function):
+        """Runs ``function()`` on the given executor, within the concurrency
+        limit"""
+
+        loop = asyncio.get_running_loop()
+        if self.m_semaphore is None or self.m_loop() is not loop:
+            # asyncio primitives belong to the loop which first uses them
+            self.m_semaphore = asyncio.Semaphore(self.m_concurrency)
+            self.m_loop = weakref.ref(loop)
+        async with self.m_semaphore:
+            return await loop.run_in_executor(executor, function)
+
+    async def objects(self, **kwargs):
+        """Returns the result of :py:meth:`.Database.objects`"""
+
+        return await self._run(self.database.objects, **kwargs)
+
+    async def records(self, **kwargs):
+        """Returns the result of :py:meth:`.Database.records`"""
+
+        return await self._run(self.database.records, **kwargs)
+
+    async def clients(self, **kwargs):
+        """Returns the result of :py:meth:`.Database.clients`"""
+
+        return await self._run(self.database.clients, **kwargs)
+
+    async def paths(self, ids, prefix='', suffix=''):
+        """Returns the result of :py:meth:`.Database.paths`"""
+
+        return await self._run(self.database.paths, ids, prefix, suffix)
+
+    async def make_paths(self, objects_or_ids, directory=None, extension=None):
+        """Returns the result of :py:meth:`.Database.make_paths`"""
+
+        return await self._run(self.database.make_paths, objects_or_ids, directory, extension)
+
+    async def load_audio(self, objects, directory=None, dtype=None):
+        """Loads the audio samples of many files, as
+        :py:meth:`.Database.load_audio` does, reading each file on the
+        executor
+
+        Returns a list with one array of shape ``(channels, samples)`` per
+        file.
+        """
+
+        from .audio import read_wav
+
+        if directory is None:
+            directory = self.database.original_directory
+        paths = await self.make_paths(list(objects), directory, self.database.original_extension or '.wav')
+        return list(await asyncio.gather(*[self._run(read_wav, path, dtype) for path in paths]))
+
+    async def iter_objects(self, chunk_size=1000, **kwargs):
+        """Yields the objects of :py:meth:`.Database.iter_objects`, reading
+        them in chunks on a thread of their own, as its queries are bound to
+        the session of that thread"""
+
+        stream = self.database.iter_objects(chunk_size=chunk_size, **kwargs)
+        reader = ThreadPoolExecutor(max_workers=1)
+        try:
+            while True:
+                chunk = await self._run_on(reader, lambda: list(itertools.islice(stream, chunk_size)))
+                for k in chunk:
+                    yield k
+                if len(chunk) < chunk_size:
+                    return
+        finally:
+            # the stream and the session are closed on their thread, once the
+            # chunk being read (if the iteration was abandoned) is done,
+            # without waiting for it
+            reader.submit(self._close_stream, stream)
+            reader.shutdown(wait=False)
+
+    def _close_stream(self, stream):
+        """Closes a stream of :py:meth:`AsyncDatabase.iter_objects` and the
+        session of the thread which read it"""
+
+        stream.close()
+        self.database.close_sessions(all_threads=False)
+
+    def close(self):
+        """Waits for the running calls, stops the threads and closes their
+        database sessions"""
+
+        self.m_executor.shutdown(wait=True)
+        self.database.close_sessions()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await asyncio.get_running_loop().run_in_executor(None, self.close)
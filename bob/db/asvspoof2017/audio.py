@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""Low-level access to the WAV files of the ASVspoof2017 database.
+"""
+
+import os
+import struct
+import collections
+
+
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_IEEE_FLOAT = 0x0003
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+SAMPLE_BITS = {WAVE_FORMAT_PCM: (8, 16, 32), WAVE_FORMAT_IEEE_FLOAT: (32,)}
+"""The numbers of bits per sample supported for each format, those of the
+samples which map to a NumPy type"""
+
+
+class WavInfo(collections.namedtuple('WavInfo', ('rate', 'channels', 'bits', 'format', 'offset', 'size'))):
+    """The header of a WAV file, as returned by :py:func:`wav_info`
+
+    rate
+        The sampling rate, in Hz.
+
+    channels
+        The number of interleaved channels.
+
+    bits
+        The number of bits per sample.
+
+    format
+        The format tag: ``1`` for integer PCM, ``3`` for floating point. The
+        sub-format is reported for extensible files.
+
+    offset
+        The position, in bytes, of the first sample in the file.
+
+    size
+        The size, in bytes, of the sample data, as declared in the header.
+    """
+
+    __slots__ = ()
+
+    @property
+    def frame_size(self):
+        """The number of bytes used by all channels of one sample"""
+        return self.channels * (self.bits // 8)
+
+    @property
+    def nframes(self):
+        """The number of samples per channel, as declared in the header"""
+        return self.size // self.frame_size
+
+    @property
+    def duration(self):
+        """The duration of the file, in seconds"""
+        return float(self.nframes) / self.rate
+
+    @property
+    def dtype(self):
+        """The NumPy type (as a string) of the samples"""
+        if self.format == WAVE_FORMAT_IEEE_FLOAT:
+            return '<f%d' % (self.bits // 8)
+        if self.bits == 8:
+            return 'u1'  # 8 bit PCM is unsigned
+        return '<i%d' % (self.bits // 8)
+
+
+def wav_info(path):
+    """Reads the header of a RIFF/WAVE file
+
+    Keyword parameters:
+
+    path
+        The path to the WAV file.
+
+    Returns a :py:class:`WavInfo`. Raises a :py:exc:`ValueError` if the file is
+    not a valid WAV file with 8, 16 or 32 bit integer, or 32 bit floating point,
+    samples (see :py:data:`SAMPLE_BITS`). The returned
+    data size is the one declared in the header: compare it to the size of the
+    file to detect truncation (see :py:func:`is_truncated`).
+    """
+
+    with open(path, 'rb') as f:
+        header = f.read(12)
+        if len(header) < 12 or header[:4] != b'RIFF' or header[8:12] != b'WAVE':
+            raise ValueError("`%s' is not a RIFF/WAVE file" % path)
+
+        fmt = None
+        while True:
+            chunk = f.read(8)
+            if len(chunk) < 8:
+                raise ValueError("`%s' has no %s chunk" % (path, 'data' if fmt else 'fmt'))
+            name, size = struct.unpack('<4sI', chunk)
+
+            if name == b'fmt ':
+                if size < 16:
+                    raise ValueError("`%s' has an invalid fmt chunk" % path)
+                body = f.read(size)
+                if len(body) < size:
+                    raise ValueError("`%s' has a truncated fmt chunk" % path)
+                tag, channels, rate, _, align, bits = struct.unpack('<HHIIHH', body[:16])
+                if tag == WAVE_FORMAT_EXTENSIBLE and size >= 26:
+                    tag = struct.unpack('<H', body[24:26])[0]
+                if bits not in SAMPLE_BITS.get(tag, ()) or not channels or not rate \
+                        or align != channels * (bits // 8):
+                    raise ValueError("`%s' has an unsupported sample format" % path)
+                fmt = (rate, channels, bits, tag)
+
+            elif name == b'data':
+                if fmt is None:
+                    raise ValueError("`%s' has a data chunk before the fmt chunk" % path)
+                return WavInfo(*(fmt + (f.tell(), size)))
+
+            else:
+                f.seek(size, os.SEEK_CUR)
+
+            # chunks are word aligned
+            if size % 2:
+                f.seek(1, os.SEEK_CUR)
+
+
+def is_truncated(path, info):
+    """Tells if the file is shorter than the sample data declared in its
+    :py:class:`WavInfo` header"""
+
+    return os.path.getsize(path) < info.offset + info.size
+
+
+def read_wav(path, dtype=None):
+    """Reads all samples of a WAV file
+
+    Keyword parameters:
+
+    path
+        The path to the WAV file.
+
+    dtype
+        The NumPy type of the returned samples. By default, it is the type of
+        the samples in the file (``int16`` for the ASVspoof2017 files). Values
+        are converted, not rescaled.
+
+    Returns an array of shape ``(channels, samples)``, as :py:mod:`bob.io.audio`
+    does. Raises a :py:exc:`ValueError` if the file is not a valid WAV file
+    and an :py:exc:`IOError` if it is truncated.
+    """
+
+    import numpy
+
+    info = wav_info(path)
+    nframes = info.nframes
+    data = numpy.empty(nframes * info.channels, dtype=info.dtype)
+    with open(path, 'rb') as f:
+        f.seek(info.offset)
+        # reads straight into the array, without holding the GIL
+        size = f.readinto(data.view(numpy.uint8))
+    if size < data.nbytes:
+        raise IOError("`%s' is truncated: %d bytes of samples instead of %d" % (path, size, data.nbytes))
+
+    data = data.reshape(nframes, info.channels).T
+    if dtype is not None:
+        return data.astype(dtype)
+    return numpy.ascontiguousarray(data)
+
+
+def wav_memmap(path):
+    """Maps the samples of a WAV file in memory, without reading them
+
+    Keyword parameters:
+
+    path
+        The path to the WAV file.
+
+    Returns a read-only :py:class:`numpy.memmap` of shape ``(channels,
+    samples)``. Samples are only read from disk when accessed, so that taking
+    windows of long files is cheap. The returned array has the attributes
+    ``rate`` (the sampling rate, in Hz), ``channels`` and ``info`` (the
+    :py:class:`WavInfo` of the file). Raises a :py:exc:`ValueError` if the file
+    is not a valid WAV file and an :py:exc:`IOError` if it is truncated.
+    """
+
+    import numpy
+
+    info = wav_info(path)
+    if is_truncated(path, info):
+        raise IOError("`%s' is truncated: the header declares %d bytes of samples" % (path, info.size))
+
+    if info.nframes:
+        data = numpy.memmap(path, dtype=info.dtype, mode='r', offset=info.offset,
+                            shape=(info.nframes, info.channels)).T
+    else:
+        # empty files cannot be mapped
+        data = numpy.empty((info.channels, 0), dtype=info.dtype).view(numpy.memmap)
+    data.rate = info.rate
+    data.channels = info.channels
+    data.info = info
+    return data
@@ -10,32 +10,241 @@ import os
 import sys
 
 
+def list_directory(directory):
+    """Returns the set of names in a directory, an empty set if it does not
+    exist, or None if it cannot be listed"""
+
+    try:
+        return set(entry.name for entry in os.scandir(directory or os.curdir))
+    except (FileNotFoundError, NotADirectoryError):
+        return set()
+    except OSError:
+        return None
+
+
+def find_missing(paths, method='listdir', num_workers=8, progress=None):
+    """Returns the paths, among the given ones, that do not exist on the
+    filesystem
+
+    Keyword parameters:
+
+    paths
+        An iterable of file paths.
+
+    method
+        ``'listdir'`` lists each distinct parent directory once and looks the
+        file names up in the listing. Files in directories that cannot be listed
+        are checked with ``'stat'``, which calls :py:func:`os.path.exists` for
+        every file.
+
+    num_workers
+        The number of threads listing directories or checking files in
+        parallel.
+
+    progress
+        If given, it is called as ``progress(done, total)`` as files are checked.
+
+    Returns the list of missing paths, in the given order.
+    """
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    paths = list(paths)
+    total = len(paths)
+    done = [0]
+
+    def report(n):
+        done[0] += n
+        if progress is not None:
+            progress(done[0], total)
+
+    exists = {}
+    with ThreadPoolExecutor(max_workers=max(1, num_workers)) as pool:
+        stat = paths
+        if method == 'listdir':
+            by_directory = {}
+            for p in paths:
+                by_directory.setdefault(os.path.dirname(p), []).append(p)
+            stat = []
+            directories = list(by_directory)
+            for directory, names in zip(directories, pool.map(list_directory, directories)):
+                files = by_directory[directory]
+                if names is None:
+                    stat.extend(files)
+                    continue
+                for p in files:
+                    exists[p] = os.path.basename(p) in names
+                report(len(files))
+        elif method != 'stat':
+            raise ValueError("Unknown method `%s', choose 'listdir' or 'stat'" % method)
+
+        chunk = 256
+        for i, found in enumerate(pool.map(os.path.exists, stat)):
+            exists[stat[i]] = found
+            if (i + 1) % chunk == 0 or i + 1 == len(stat):
+                report((i % chunk) + 1)
+
+    return [p for p in paths if not exists[p]]
+
+
+def verify_file(path):
+    """Checks the WAV header and computes the content digest of a file
+
+    Returns a tuple ``(path, size, mtime, status, digest)``, where ``status``
+    is one of ``'ok'``, ``'missing'``, ``'unreadable'`` (it cannot be opened
+    or read), ``'corrupt'`` (not a valid WAV file) or ``'truncated'``
+    (shorter than declared in its header), and ``digest`` is the SHA-256 of
+    the file contents (``None`` for missing and unreadable files).
+    """
+
+    import hashlib
+    from .audio import wav_info, is_truncated
+
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return path, None, None, 'missing', None
+
+    try:
+        try:
+            status = 'truncated' if is_truncated(path, wav_info(path)) else 'ok'
+        except ValueError:
+            status = 'corrupt'
+
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+    except OSError:
+        return path, stat.st_size, stat.st_mtime, 'unreadable', None
+
+    return path, stat.st_size, stat.st_mtime, status, digest.hexdigest()
+
+
+def load_manifest(filename):
+    """Loads a verification manifest, as written by :py:func:`save_manifest`.
+    Returns an empty manifest if the file does not exist."""
+
+    import json
+    if not filename or not os.path.exists(filename):
+        return {}
+    with open(filename) as f:
+        return json.load(f)
+
+
+def save_manifest(filename, manifest):
+    """Atomically writes a verification manifest, a dictionary mapping each
+    path to its ``size``, ``mtime``, ``status`` and ``digest``"""
+
+    import json
+    tmpfile = '%s.%d.tmp' % (filename, os.getpid())
+    with open(tmpfile, 'w') as f:
+        json.dump(manifest, f, indent=0, sort_keys=True)
+    os.replace(tmpfile, filename)
+
+
+def verify(paths, manifest=None, rehash=False, num_workers=None, progress=None):
+    """Verifies the WAV headers and the contents of many files
+
+    Keyword parameters:
+
+    paths
+        An iterable of file paths.
+
+    manifest
+        The results of a previous verification, as a dictionary mapping each
+        path to its ``size``, ``mtime``, ``status`` and ``digest``. Files whose
+        size and modification time did not change are not verified again. It
+        is updated in place with the new results.
+
+    rehash
+        If set, verifies all files, comparing their digest to the one in the
+        manifest, to detect modifications that kept the size and time.
+
+    num_workers
+        The number of processes hashing files in parallel (defaults to the
+        number of CPUs).
+
+    progress
+        If given, it is called as ``progress(done, total)`` as files are
+        verified.
+
+    Returns a tuple ``(results, mismatched)``: ``results`` maps each path to
+    its status and ``mismatched`` lists the files whose digest is not the one in
+    the manifest.
+    """
+
+    from concurrent.futures import ProcessPoolExecutor
+
+    if manifest is None:
+        manifest = {}
+    paths = list(paths)
+    results = {}
+    todo = []
+    for path in paths:
+        entry = manifest.get(path)
+        if entry is not None and not rehash:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                stat = None
+            if stat is not None and (stat.st_size, stat.st_mtime) == (entry['size'], entry['mtime']):
+                results[path] = entry['status']
+                continue
+        todo.append(path)
+
+    if progress is not None:
+        progress(len(results), len(paths))
+
+    mismatched = []
+    with ProcessPoolExecutor(max_workers=num_workers) as pool:
+        for path, size, mtime, status, digest in pool.map(verify_file, todo, chunksize=16):
+            previous = manifest.get(path)
+            if previous is not None and digest is not None and previous['digest'] != digest:
+                mismatched.append(path)
+            results[path] = status
+            if digest is None:
+                # missing or unreadable, verified again next time
+                manifest.pop(path, None)
+            else:
+                manifest[path] = dict(size=size, mtime=mtime, status=status, digest=digest)
+            if progress is not None:
+                progress(len(results), len(paths))
+
+    return results, mismatched
+
+
 # Driver API
 # ==========
 
+def _report_progress(done, total):
+    """Reports the progress of :py:func:`checkfiles` on stderr"""
+
+    sys.stderr.write('\rchecked %d of %d files' % (done, total))
+    if done == total:
+        sys.stderr.write('\n')
+
+
 def checkfiles(args):
     """Checks existence files based on your criteria"""
 
+    import time
     from .query import Database
     db = Database()
 
-    r = db.objects(
-        protocol=args.protocol,
-        attacks=args.attacks,
-        groups=args.group,
-        purposes=args.purposes,
-        gender=args.gender,
-        clients=args.client,
-    )
-
-    # go through all files, check if they are available on the filesystem
-    good = []
-    bad = []
-    for f in r:
-        if os.path.exists(f.make_path(args.directory, args.extension)):
-            good.append(f)
-        else:
-            bad.append(f)
+    # protocols and clients are only validated here, not at parser construction
+    try:
+        r = db.records(
+            protocol=args.protocol,
+            attacks=args.attacks,
+            groups=args.group,
+            purposes=args.purposes,
+            gender=args.gender,
+            clients=args.client,
+        )
+    except ValueError as e:
+        sys.stderr.write('checkfiles: error: %s\n' % e)
+        return 2
 
     # report
     output = sys.stdout
@@ -43,15 +252,60 @@ def checkfiles(args):
         from bob.db.base.utils import null
         output = null()
 
+    progress = _report_progress if args.progress else None
+
+    if args.verify:
+        return _verify(args, db, r, output, progress)
+
+    # go through all files, check if they are available on the filesystem
+    start = time.time()
+    bad = find_missing(db.make_paths(r, args.directory, args.extension),
+                       method=args.method, num_workers=args.workers, progress=progress)
+    elapsed = time.time() - start
+
     if bad:
-        for f in bad:
-            output.write('Cannot find file "%s"\n' % (f.make_path(args.directory, args.extension),))
+        for path in bad:
+            output.write('Cannot find file "%s"\n' % (path,))
         output.write('%d files (out of %d) were not found at "%s"\n' % \
                      (len(bad), len(r), args.directory))
 
+    output.write('Checked %d files in %.2f seconds (%.0f files/s)\n' %
+                 (len(r), elapsed, len(r) / elapsed if elapsed else 0.))
+
     return 0
 
 
+def _verify(args, db, r, output, progress):
+    """Verifies the contents of the files, for :py:func:`checkfiles`"""
+
+    import time
+
+    start = time.time()
+    manifest = load_manifest(args.manifest)
+    results, mismatched = verify(db.make_paths(r, args.directory, args.extension or '.wav'),
+                                 manifest=manifest, rehash=args.rehash, num_workers=args.workers,
+                                 progress=progress)
+    if args.manifest:
+        save_manifest(args.manifest, manifest)
+    elapsed = time.time() - start
+
+    bad = 0
+    for path, status in sorted(results.items()):
+        if status != 'ok':
+            bad += 1
+            output.write('%s file "%s"\n' % (status.capitalize(), path))
+    for path in mismatched:
+        output.write('Modified file "%s" (content differs from the manifest)\n' % path)
+    if bad or mismatched:
+        output.write('%d files (out of %d) are missing, unreadable, corrupt or truncated, %d were modified '
+                     'at "%s"\n' % (bad, len(r), len(mismatched), args.directory))
+
+    output.write('Verified %d files in %.2f seconds (%.0f files/s)\n' %
+                 (len(r), elapsed, len(r) / elapsed if elapsed else 0.))
+
+    return 1 if bad or mismatched else 0
+
+
 def add_command(subparsers):
     """Add specific subcommands that the action "checkfiles" can use"""
 
@@ -59,16 +313,9 @@ def add_command(subparsers):
 
     parser = subparsers.add_parser('checkfiles', help=checkfiles.__doc__)
 
-    from .query import Database
-
-    db = Database()
-
-    if not db.is_valid():
-        protocols = ('waiting', 'for', 'database', 'creation')
-        clients = tuple()
-    else:
-        protocols = [k.name for k in db.protocols()]
-        clients = [k.id for k in db.clients()]
+    # choices come from the model definitions: building the parser must not
+    # open the database
+    from .models import Client, File
 
     parser.add_argument('-d', '--directory', dest="directory", default='',
                         help="if given, this path will be prepended to every entry checked (defaults to '%(default)s')")
@@ -76,23 +323,37 @@ def add_command(subparsers):
                         help="if given, this extension will be appended to every entry checked (defaults to '%(default)s')")
     parser.add_argument('-c', '--purpose', dest="purposes", default='genuine',
                         help="if given, limits the check to a particular subset of the data that corresponds to "
-                             "the given purpose (defaults to '%(default)s')", choices=db.purposes())
+                             "the given purpose (defaults to '%(default)s')", choices=File.purpose_choices)
     parser.add_argument('-g', '--group', dest="group", default='train',
                         help="if given, this value will limit the check to those files belonging to a particular "
-                             "protocol group, e.g., train, dev, and eval. (defaults to '%(default)s')", choices=db.groups())
+                             "protocol group, e.g., train, dev, and eval. (defaults to '%(default)s')", choices=Client.group_choices)
     parser.add_argument('-a', '--attacks', dest="attacks", default='undefined',
                         help="if given, this value will limit the check to those files using this type of attack. "
-                             "(defaults to '%(default)s')", choices=db.attack_supports())
+                             "(defaults to '%(default)s')", choices=File.attack_choices)
     parser.add_argument('-x', '--protocol', dest="protocol", default='competition',
-                        help="if given, this value will limit the check to those files for a given protocol. (defaults to '%(default)s')",
-                        choices=protocols)
+                        help="if given, this value will limit the check to those files for a given protocol. (defaults to '%(default)s')")
     parser.add_argument('-v', '--gender', dest="gender", default='undefined',
                         help="if given, this value will limit the check to those samples belonging to a specific "
                              "gender. (defaults to '%(default)s')",
-                        choices=db.genders())
-    parser.add_argument('-C', '--client', dest="client", default=None, type=int,
-                        help="if given, limits the dump to a particular client (defaults to '%(default)s')",
-                        choices=clients)
+                        choices=Client.gender_choices)
+    parser.add_argument('-C', '--client', dest="client", default=None, type=str,
+                        help="if given, limits the check to a particular client (defaults to '%(default)s')")
+    parser.add_argument('-m', '--method', dest="method", default='listdir', choices=('listdir', 'stat'),
+                        help="how to check files: 'listdir' lists every directory once, 'stat' checks every file "
+                             "on its own (defaults to '%(default)s')")
+    parser.add_argument('-j', '--workers', dest="workers", default=8, type=int,
+                        help="the number of threads checking files, or of processes verifying them, in parallel "
+                             "(defaults to '%(default)s')")
+    parser.add_argument('-V', '--verify', dest="verify", default=False, action='store_true',
+                        help="if given, checks the WAV header and computes the digest of every file, reporting "
+                             "corrupt, truncated and modified files (the extension defaults to '.wav')")
+    parser.add_argument('-M', '--manifest', dest="manifest", default=None, metavar='FILE',
+                        help="with --verify, a file keeping the results, so that only files whose size or "
+                             "modification time changed are verified again (defaults to '%(default)s')")
+    parser.add_argument('-H', '--rehash', dest="rehash", default=False, action='store_true',
+                        help="with --verify, verifies all files again and compares them to the manifest")
+    parser.add_argument('-P', '--progress', dest="progress", default=False, action='store_true',
+                        help="if given, reports the progress of the check on stderr")
     parser.add_argument('--self-test', dest="selftest", default=False,
                         action='store_true', help=SUPPRESS)
 
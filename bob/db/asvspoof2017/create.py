@@ -8,6 +8,7 @@
 
 from __future__ import print_function
 
+import sys
 import fnmatch
 
 import glob
@@ -16,27 +17,7 @@ from .models import *
 import os.path
 
 
-def add_file(session, protocol, path, purpose, attack_type, group, phrase_id, environment_id,
-             playback_device, recording_device, client_id='undefined', gender='undefined'):
-    db_client = session.query(Client).filter(Client.id == client_id).first()
-    if db_client == None:
-        db_client = Client(client_id, gender, group)
-        session.add(db_client)
-
-    db_file = session.query(File).filter(File.path == path).first()
-    if db_file == None:
-        db_file = File(db_client, purpose, attack_type, phrase_id, environment_id, playback_device, recording_device, path, group)
-        session.add(db_file)
-
-    # add find the correct protocol
-    db_protocol = session.query(Protocol).filter(Protocol.name == protocol).first()
-    if db_protocol == None:
-        raise ValueError("Protocol %s should have been created before adding files to the database!" % (protocol))
-
-    # link file and the protocol
-    session.add(ProtocolFiles(db_protocol, db_file))
-
-def add_2_columns(session, samplesdir, filename, protocol, group, splitline, gender):
+def parse_2_columns(filename, protocol, group, splitline):
     if protocol == 'competition':
         # in this case, there are only two columns: name of the file and phrase that was read
         samplename = splitline[0]
@@ -53,11 +34,10 @@ def add_2_columns(session, samplesdir, filename, protocol, group, splitline, gen
     else:
         raise ValueError("Protocol file `%s' is not supported." % filename)
 
-    sample_path = os.path.join(samplesdir, samplesfolder, samplename)
-    add_file(session, protocol, sample_path, purpose, attack_type, group, phrase_id, environment_id,
-             playback_device, recording_device, client_id=client, gender=gender)
+    return (samplesfolder, samplename, purpose, attack_type, phrase_id, environment_id,
+            playback_device, recording_device, client)
 
-def add_7_columns(session, samplesdir, filename, protocol, group, splitline, gender):
+def parse_7_columns(filename, protocol, group, splitline):
 
     if protocol == 'competition':
         samplename = splitline[0]
@@ -82,68 +62,388 @@ def add_7_columns(session, samplesdir, filename, protocol, group, splitline, gen
     else:
         raise ValueError("Protocol file `%s' is not supported." % filename)
 
-    sample_path = os.path.join(samplesdir, samplesfolder, samplename)
-    add_file(session, protocol, sample_path, purpose, attack_type, group, phrase_id, environment_id,
-             playback_device, recording_device, client_id=client, gender=gender)
+    return (samplesfolder, samplename, purpose, attack_type, phrase_id, environment_id,
+            playback_device, recording_device, client)
+
+
+def stable_id(path, taken=()):
+    """Returns the id of the file with the given path: a positive 52 bit integer
+    derived from a hash of the path, so that it does not depend on the order in
+    which files are read. Should that value be ``taken``, the next free one is
+    used."""
 
+    import hashlib
 
-def add_protocol_samples(session, protodir, samplesdir, filename, protocol, group, gender):
-    # read and add file to the database
+    value = int(hashlib.sha256(path.encode('utf-8')).hexdigest()[:13], 16) or 1
+    while value in taken:
+        value = value % (2 ** 52 - 1) + 1
+    return value
+
+
+def id_map_path(dbfile):
+    """Returns the path of the file id map kept next to the given database
+    file"""
+
+    return os.path.splitext(dbfile)[0] + '.ids'
+
+
+def load_id_map(filename):
+    """Reads the ids of the files ever written to a database, as a dictionary
+    mapping their paths to their ids. Returns an empty dictionary if there is no
+    such map."""
+
+    if not os.path.exists(filename):
+        return {}
+    with open(filename) as f:
+        return dict((path, int(id)) for path, id in (line.split() for line in f if line.strip()))
+
+
+def read_ids(dbtype, dbfile):
+    """Returns the ids of the files of an existing database, as a dictionary
+    mapping their paths to their ids, or an empty one if it cannot be read"""
+
+    from sqlalchemy.exc import DatabaseError
+    from bob.db.base.utils import session_try_readonly
+
+    s = session_try_readonly(dbtype, dbfile)
+    try:
+        return dict(s.query(File.path, File.id))
+    except DatabaseError:
+        return {}
+    finally:
+        s.close()
+
+
+def save_id_map(filename, ids):
+    """Writes the id map (see :py:func:`load_id_map`), sorted by path, replacing
+    the file atomically"""
+
+    tmpfile = '%s.%d.tmp' % (filename, os.getpid())
+    with open(tmpfile, 'w') as f:
+        f.writelines('%s %d\n' % (path, ids[path]) for path in sorted(ids))
+    os.replace(tmpfile, filename)
+
+
+class Tables(object):
+    """In-memory client, file and protocol link tables, filled while parsing the
+    protocol files and written to the database in bulk afterwards
+
+    File ids are taken from the given id map, if it has the path, or else are
+    derived from the path (see :py:func:`stable_id`). New ids are added to the
+    map.
+    """
+
+    def __init__(self, ids=None):
+        self.protocols = {}  # name -> id
+        self.clients = {}  # id -> row
+        self.files = {}  # path -> row
+        self.links = []
+        self.sources = {}  # protocol file name -> row
+        self.ids = {} if ids is None else ids  # path -> file id
+        self.taken = set(self.ids.values())
+
+    def add_protocol(self, name):
+        if name not in self.protocols:
+            self.protocols[name] = len(self.protocols) + 1
+        return self.protocols[name]
+
+    def add_file(self, protocol, path, purpose, attack_type, group, phrase_id, environment_id,
+                 playback_device, recording_device, client_id='undefined', gender='undefined', source=None):
+        # first occurrence wins, as for the entries already in the database
+        if client_id not in self.clients:
+            self.clients[client_id] = dict(id=client_id, gender=gender, group=group)
+
+        db_file = self.files.get(path)
+        if db_file is None:
+            if path not in self.ids:
+                self.ids[path] = stable_id(path, self.taken)
+                self.taken.add(self.ids[path])
+            db_file = dict(id=self.ids[path], client_id=client_id, purpose=purpose,
+                           attacktype=attack_type, common_phrase=phrase_id, environment=environment_id,
+                           playback_device=playback_device, recording_device=recording_device,
+                           path=path, group=group, source=source)
+            self.files[path] = db_file
+
+        if protocol not in self.protocols:
+            raise ValueError("Protocol %s should have been created before adding files to the database!" % (protocol))
+
+        # link file and the protocol
+        self.links.append(dict(id=len(self.links) + 1, protocol_id=self.protocols[protocol],
+                               file_id=db_file['id']))
+
+    def write(self, session):
+        """Inserts all rows with one ``executemany`` per table, inside the
+        session's current transaction"""
+
+        tables = (
+            (Protocol, [dict(id=v, name=k) for k, v in self.protocols.items()]),
+            (Client, list(self.clients.values())),
+            (File, list(self.files.values())),
+            (ProtocolFiles, self.links),
+            (Source, [dict(k, id=i) for i, k in enumerate(self.sources.values(), 1)]),
+        )
+        for model, rows in tables:
+            if rows:
+                session.execute(model.__table__.insert(), rows)
+
+
+def add_protocol_samples(tables, protodir, samplesdir, filename, protocol, group, gender):
+    # read and add file to the in-memory tables
     with open(os.path.join(protodir, filename)) as f:
         lines = f.readlines()
     for line in lines:
         splitline = (line.strip()).split(' ')
 
         if len(splitline) == 2:  # eval set of the competition
-            add_2_columns(session, samplesdir, filename, protocol, group, splitline, gender)
+            row = parse_2_columns(filename, protocol, group, splitline)
         elif len(splitline) == 7:  # train and dev sets of the competition
-            add_7_columns(session, samplesdir, filename, protocol, group, splitline, gender)
+            row = parse_7_columns(filename, protocol, group, splitline)
         else:
-            raise ValueError("Protocol file should contain either 7 items per line or 2." % filename)
+            raise ValueError("Protocol file `%s' should contain either 7 items per line or 2." % filename)
+
+        samplesfolder, samplename, purpose, attack_type, phrase_id, environment_id, \
+            playback_device, recording_device, client = row
+        sample_path = os.path.join(samplesdir, samplesfolder, samplename)
+        tables.add_file(protocol, sample_path, purpose, attack_type, group, phrase_id, environment_id,
+                        playback_device, recording_device, client_id=client, gender=gender,
+                        source=os.path.basename(filename))
+
+def fingerprint(filename):
+    """Returns the SHA-256 digest of the contents of a protocol file"""
+
+    import hashlib
+
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def add_protocol_file(tables, protodir, samplesdir, filename):
+    """Adds the protocol and samples of a protocol file to the tables, returns
+    the group of its samples"""
+
+    # skip hidden files
+    # if filename.startswith('.'):
+    #     continue
+    # skip directories
+    # if os.path.isdir(os.path.join(protodir, filename)):
+    #     continue
+
+    print("Processing file %s" % filename)
+    # remove extension
+    fname = os.path.splitext(os.path.basename(filename.strip()))[0]
+    # parse the name
+    s = fname.split('_')
+    print("Basename %s" % fname)
+
+    group = s[1]  #train, develop, or evaluation
+    protocol = 'competition'
+    # protocol used in the ASVspoof 2017 competition
+    if protocol == 'competition':
+        gender = 'undefined'
+    else:
+        raise ValueError("Protocol file `%s' is not supported." % filename)
 
-def init_database(session, protodir, samplesdir, protocol_file_list):
+    # add protocol only if it does not exist
+    tables.add_protocol(protocol)
+    # add samples from the protocol file to the in-memory tables
+    add_protocol_samples(tables, protodir, samplesdir, filename, protocol, group, gender)
+
+    name = os.path.basename(filename)
+    tables.sources[name] = dict(filename=name, group=group,
+                                checksum=fingerprint(os.path.join(protodir, filename)))
+    return group
+
+
+def init_database(session, protodir, samplesdir, protocol_file_list, ids=None):
     """Defines all available protocols"""
 
+    tables = Tables(ids)
+
     for filename in protocol_file_list:
-        # skip hidden files
-        # if filename.startswith('.'):
-        #     continue
-        # skip directories
-        # if os.path.isdir(os.path.join(protodir, filename)):
-        #     continue
-
-        print("Processing file %s" % filename)
-        # remove extension
-        fname = os.path.splitext(os.path.basename(filename.strip()))[0]
-        # parse the name
-        s = fname.split('_')
-        print("Basename %s" % fname)
-
-        group = s[1]  #train, develop, or evaluation
-        protocol = 'competition'
-        # protocol used in the ASVspoof 2017 competition
-        if protocol == 'competition':
-            gender = 'undefined'
+        add_protocol_file(tables, protodir, samplesdir, filename)
+
+    # a single bulk insert per table, no per-line lookups
+    tables.write(session)
+
+
+def update_database(session, protodir, samplesdir, protocol_file_list, ids=None):
+    """Applies the changes of the protocol files since they were last ingested
+
+    Only the protocol files which are new, or whose fingerprint changed, are
+    read again. The files they list are compared to the database by path: new
+    files are inserted, and files with different attributes are updated in
+    place, keeping their id. The files which came from these protocol files
+    (or from the protocol files which were removed) and are no longer listed
+    are deleted. Clients left without files are deleted as well.
+
+    Returns a dictionary with the number of ``inserted``, ``updated`` and
+    ``deleted`` files.
+    """
+
+    from sqlalchemy import func, bindparam
+
+    counts = dict(inserted=0, updated=0, deleted=0)
+
+    known = dict((k.filename, k) for k in session.query(Source))
+    current = dict((os.path.basename(k), k) for k in protocol_file_list)
+    changed = [current[k] for k in sorted(current)
+               if k not in known or known[k].checksum != fingerprint(os.path.join(protodir, current[k]))]
+    removed = [known[k] for k in sorted(known) if k not in current]
+    if not changed and not removed:
+        return counts
+
+    tables = Tables(ids)
+    # ids of databases created before the id map are kept, and not reused
+    tables.taken.update(k[0] for k in session.query(File.id))
+    for filename in changed:
+        add_protocol_file(tables, protodir, samplesdir, filename)
+    sources = set(k.filename for k in removed) | set(os.path.basename(k) for k in changed)
+
+    # protocols and clients are only ever added here
+    protocols = dict((k.name, k.id) for k in session.query(Protocol))
+    for name in tables.protocols:
+        if name not in protocols:
+            protocols[name] = (session.query(func.max(Protocol.id)).scalar() or 0) + 1
+            session.execute(Protocol.__table__.insert(), [dict(id=protocols[name], name=name)])
+    clients = set(k[0] for k in session.query(Client.id))
+    rows = [v for k, v in tables.clients.items() if k not in clients]
+    if rows:
+        session.execute(Client.__table__.insert(), rows)
+
+    table = File.__table__
+    # the columns set from the protocol files
+    columns = [k for k in table.columns.keys() if k not in ('id', 'path', 'rate', 'samples', 'duration')]
+    # the files of the changed protocol files, and the ones they now list. In
+    # databases created before the protocol files were recorded, all files
+    # are read again, and the ones no longer listed are deleted.
+    existing = dict((r.path, r) for r in session.execute(table.select())
+                    if r.source in sources or r.path in tables.files or not known)
+
+    inserts, updates = [], []
+    file_ids = {}  # id in the tables -> id in the database
+    for path, row in tables.files.items():
+        old = existing.get(path)
+        if old is None:
+            inserts.append(row)
+            file_ids[row['id']] = row['id']
         else:
-            raise ValueError("Protocol file `%s' is not supported." % filename)
-
-        # add protocol only if it does not exist
-        db_protocol = session.query(Protocol).filter(Protocol.name == protocol).first()
-        if db_protocol is None:
-            session.add(Protocol(protocol))
-            session.flush()
-        # add samples from the protocol file to the database
-        add_protocol_samples(session, protodir, samplesdir, filename, protocol, group, gender)
+            file_ids[row['id']] = old.id
+            if any(row[k] != getattr(old, k) for k in columns):
+                updates.append(dict(((k, row[k]) for k in columns), _id=old.id))
+    deletes = [r.id for path, r in existing.items() if path not in tables.files]
+
+    if inserts:
+        session.execute(table.insert(), inserts)
+    if updates:
+        session.execute(table.update().where(table.c.id == bindparam('_id')), updates)
+
+    # the protocol links of these files are recreated
+    links = ProtocolFiles.__table__
+    ids = [r.id for r in existing.values()]
+    for i in range(0, len(ids), 500):
+        session.execute(links.delete().where(links.c.file_id.in_(ids[i:i + 500])))
+    for i in range(0, len(deletes), 500):
+        session.execute(table.delete().where(table.c.id.in_(deletes[i:i + 500])))
+    next_id = (session.query(func.max(ProtocolFiles.id)).scalar() or 0) + 1
+    protocol_ids = dict((v, protocols[k]) for k, v in tables.protocols.items())
+    rows = [dict(id=next_id + i, protocol_id=protocol_ids[k['protocol_id']], file_id=file_ids[k['file_id']])
+            for i, k in enumerate(tables.links)]
+    if rows:
+        session.execute(links.insert(), rows)
+
+    used = set(k[0] for k in session.query(File.client_id).distinct())
+    unused = sorted(clients - used)
+    if unused:
+        session.execute(Client.__table__.delete().where(Client.__table__.c.id.in_(unused)))
+
+    table = Source.__table__
+    session.execute(table.delete().where(table.c.filename.in_(sorted(sources))))
+    next_id = (session.query(func.max(Source.id)).scalar() or 0) + 1
+    rows = [dict(k, id=next_id + i) for i, k in enumerate(tables.sources.values())]
+    if rows:
+        session.execute(table.insert(), rows)
+
+    counts.update(inserted=len(inserts), updated=len(updates), deleted=len(deletes))
+    return counts
+
+
+def add_audio_info(session, audiodir, extension='.wav', num_workers=8, missing_only=False):
+    """Reads the headers of the audio files in parallel, and stores the
+    sampling rate, number of samples and duration of each file
+
+    Keyword parameters:
+
+    audiodir
+        The directory containing the audio files, as laid out by the file
+        paths.
+
+    missing_only
+        If set, only reads the headers of the files with no sampling rate yet,
+        for instance those added by ``create --update``.
+
+    Returns the number of files whose header could not be read: their columns
+    are left empty.
+    """
+
+    from concurrent.futures import ThreadPoolExecutor
+    from sqlalchemy import bindparam
+    from .audio import wav_info
+
+    q = session.query(File.id, File.path)
+    if missing_only:
+        q = q.filter(File.rate == None)
+    rows = q.all()
+
+    def read(path):
+        try:
+            return wav_info(os.path.join(audiodir, path + extension))
+        except (IOError, OSError, ValueError):
+            return None
+
+    with ThreadPoolExecutor(max_workers=max(1, num_workers)) as pool:
+        infos = list(pool.map(read, [k[1] for k in rows]))
+
+    updates = [dict(_id=k[0], rate=info.rate, samples=info.nframes, duration=info.duration)
+               for k, info in zip(rows, infos) if info is not None]
+    if updates:
+        table = File.__table__
+        session.execute(table.update().where(table.c.id == bindparam('_id')), updates)
+    return len(rows) - len(updates)
+
+
+def migrate_tables(engine):
+    """Adds the columns of the models which the tables of a database created
+    by an older version of this package lack, returns their names (see
+    :py:func:`.models.missing_columns`)"""
+
+    from sqlalchemy import text
+
+    with engine.begin() as connection:
+        missing = missing_columns(connection)
+        for name in missing:
+            table, column = name.split('.')
+            column = Base.metadata.tables[table].columns[column]
+            connection.execute(text('ALTER TABLE "%s" ADD COLUMN "%s" %s' %
+                                    (table, column.name, column.type.compile(engine.dialect))))
+    return missing
 
 
 def create_tables(args):
-    """Creates all necessary tables (only to be used at the first time)"""
+    """Creates all necessary tables (only to be used at the first time). With
+    ``--update``, the tables of an existing database are migrated as well."""
 
     from bob.db.base.utils import create_engine_try_nolock
 
     engine = create_engine_try_nolock(args.type, args.files[0], echo=(args.verbose >= 2))
     Client.metadata.create_all(engine)
     File.metadata.create_all(engine)
+    if args.update:
+        added = migrate_tables(engine)
+        if added:
+            print("Added the columns %s to the database" % ', '.join(added))
 
 
 # Driver API
@@ -156,6 +456,13 @@ def create(args):
 
     dbfile = args.files[0]
 
+    # the ids of all files ever created are kept, so that they do not change
+    # when the database is created again
+    ids = load_id_map(id_map_path(dbfile))
+    if args.recreate and os.path.exists(dbfile):
+        # a downloaded database comes without its id map
+        ids = dict(read_ids(args.type, dbfile), **ids)
+
     if args.recreate:
         if args.verbose and os.path.exists(dbfile):
             print('unlinking %s...' % dbfile)
@@ -164,15 +471,38 @@ def create(args):
     if not os.path.exists(os.path.dirname(dbfile)):
         os.makedirs(os.path.dirname(dbfile))
 
+    update = args.update and os.path.exists(dbfile)
+
     # the real work...
     create_tables(args)
     s = session_try_nolock(args.type, args.files[0], echo=(args.verbose >= 2))
 
+    if not update and s.query(File.id).first() is not None:
+        s.close()
+        sys.stderr.write("create: error: the database `%s' already exists, pass --recreate to create it "
+                         "again, or --update to apply the changes of the protocol files\n" % dbfile)
+        return 2
+
     # ASVspoof2017 competition protocol files
     protocol_file_list = glob.glob(os.path.join(args.protodir, 'ASVspoof2017_*'))
-    init_database(s, args.protodir, args.samplesdir, protocol_file_list)
+    if update:
+        counts = update_database(s, args.protodir, args.samplesdir, protocol_file_list, ids)
+        print("Inserted %(inserted)d, updated %(updated)d and deleted %(deleted)d files" % counts)
+    else:
+        init_database(s, args.protodir, args.samplesdir, protocol_file_list, ids)
+
+    if args.audiodir:
+        missing = add_audio_info(s, args.audiodir, num_workers=args.workers, missing_only=update)
+        if missing:
+            print("Could not read the headers of %d audio files in %s" % (missing, args.audiodir))
 
     s.commit()
+    ids.update(s.query(File.path, File.id))
+    save_id_map(id_map_path(dbfile), ids)
+
+    # the metadata snapshot, read by the 'snapshot' backend of the Database
+    from .index import ColumnarIndex, snapshot_path
+    ColumnarIndex.from_session(s).save(snapshot_path(dbfile))
     s.close()
 
     return 0
@@ -184,7 +514,10 @@ def add_command(subparsers):
     parser = subparsers.add_parser('create', help=create.__doc__)
 
     parser.add_argument('-R', '--recreate', action='store_true', default=False,
-                        help="If set, I'll first erase the current database")
+                        help="If set, I'll first erase the current database (but not its file id map)")
+    parser.add_argument('-U', '--update', action='store_true', default=False,
+                        help="If set, only applies the changes of the protocol files since the database was "
+                             "last created or updated, keeping the ids of the other files")
     parser.add_argument('-v', '--verbose', action='count', default=0,
                         help="Do SQL operations in a verbose way")
 
@@ -199,4 +532,10 @@ def add_command(subparsers):
                         metavar='DIR',
                         help="Change the relative path to the directory containing the protocol definitions for asvspoof2017 attacks (defaults to %(default)s)")
 
+    parser.add_argument('-A', '--audiodir', action='store', default=None, metavar='DIR',
+                        help="If set, the headers of the audio files in this directory are read, to store the "
+                             "sampling rate, number of samples and duration of each file")
+    parser.add_argument('-j', '--workers', action='store', default=8, type=int,
+                        help="The number of audio headers read in parallel (defaults to %(default)s)")
+
     parser.set_defaults(func=create)  # action
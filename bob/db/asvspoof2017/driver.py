@@ -82,6 +82,69 @@ def path_command(subparsers):
     parser.set_defaults(func=path)  # action
 
 
+def explain(args):
+    """Prints the SQLite query plan used to list files for some criteria"""
+
+    from .query import Database
+    db = Database()
+
+    output = sys.stdout
+    if args.selftest:
+        from bob.db.base.utils import null
+        output = null()
+
+    try:
+        plan = db.explain(
+            protocol=args.protocol,
+            attacks=args.attacks,
+            groups=args.group,
+            purposes=args.purposes,
+            gender=args.gender,
+            clients=args.client,
+        )
+    except ValueError as e:
+        sys.stderr.write('explain: error: %s\n' % e)
+        return 2
+    for step in plan: output.write('%s\n' % step)
+
+    scans = [step for step in plan if step.startswith('SCAN')]
+    if scans:
+        output.write('%d step(s) of the plan scan a whole table\n' % len(scans))
+        return 1
+
+    return 0
+
+
+def explain_command(subparsers):
+    """Adds the specific options for the explain command"""
+
+    from argparse import SUPPRESS
+    from .models import Client, File
+
+    parser = subparsers.add_parser('explain', help=explain.__doc__)
+
+    parser.add_argument('-c', '--purpose', dest="purposes", default=None,
+                        help="if given, limits the query to a particular subset of the data that corresponds to the "
+                             "given purpose (defaults to '%(default)s')", choices=File.purpose_choices)
+    parser.add_argument('-g', '--group', dest="group", default=None,
+                        help="if given, limits the query to a particular protocol group (defaults to '%(default)s')",
+                        choices=Client.group_choices)
+    parser.add_argument('-a', '--attacks', dest="attacks", default=None,
+                        help="if given, limits the query to a particular type of attack (defaults to '%(default)s')",
+                        choices=File.attack_choices)
+    parser.add_argument('-x', '--protocol', dest="protocol", default=None,
+                        help="if given, limits the query to a given protocol (defaults to '%(default)s')")
+    parser.add_argument('-v', '--gender', dest="gender", default=None,
+                        help="if given, limits the query to a specific gender (defaults to '%(default)s')",
+                        choices=Client.gender_choices)
+    parser.add_argument('-C', '--client', dest="client", default=None, type=str,
+                        help="if given, limits the query to a particular client (defaults to '%(default)s')")
+    parser.add_argument('--self-test', dest="selftest", default=False,
+                        action='store_true', help=SUPPRESS)
+
+    parser.set_defaults(func=explain)  # action
+
+
 class Interface(BaseInterface):
     def name(self):
         return 'asvspoof2017'
@@ -91,9 +154,10 @@ class Interface(BaseInterface):
         return pkg_resources.require('bob.db.%s' % self.name())[0].version
 
     def files(self):
-        from pkg_resources import resource_filename
+        import os
+        # the snapshot and the file id map written by 'create' are not needed
         raw_files = ('db.sql3',)
-        return [resource_filename(__name__, k) for k in raw_files]
+        return [os.path.join(os.path.dirname(os.path.abspath(__file__)), k) for k in raw_files]
 
     def type(self):
         return 'sqlite'
@@ -116,9 +180,16 @@ class Interface(BaseInterface):
         from .checkfiles import add_command as checkfiles_command
         checkfiles_command(subparsers)
 
+        # get the "pack" action from a submodule
+        from .pack import add_command as pack_command
+        pack_command(subparsers)
+
         # adds the "reverse" command
         reverse_command(subparsers)
 
         # adds the "path" command
         path_command(subparsers)
 
+        # adds the "explain" command
+        explain_command(subparsers)
+
@@ -9,6 +9,23 @@
 import os
 import sys
 
+balance_choices = ('count', 'duration', 'size')
+"""How shards may be balanced, as :py:attr:`.Database.balance_choices`: the
+parser is built without importing the query module"""
+
+def shard_spec(value):
+  """Parses a shard given as ``I/N``, returns ``(I, N)``"""
+
+  from argparse import ArgumentTypeError
+
+  try:
+    shard, num_shards = (int(k) for k in value.split('/'))
+  except ValueError:
+    raise ArgumentTypeError("invalid shard `%s', use I/N, as in 0/10" % value)
+  if not 0 <= shard < num_shards:
+    raise ArgumentTypeError("invalid shard `%s', I must be between 0 and N-1" % value)
+  return shard, num_shards
+
 # Driver API
 # ==========
 
@@ -16,15 +33,26 @@ def dumplist(args):
   """Dumps lists of files based on your criteria"""
 
   from .query import Database
-  db = Database()
-
-  r = db.objects(
-      protocol=args.protocol,
-      attacks=args.attacks,
-      groups=args.group,
-      purposes=args.purposes,
-      clients=args.client,
-      )
+  # the audio files are looked up for balancing shards by size
+  db = Database(original_directory=args.directory)
+
+  shard, num_shards = args.shard or (None, None)
+
+  # protocols and clients are only validated here, not at parser construction
+  try:
+    r = db.objects(
+        protocol=args.protocol,
+        attacks=args.attacks,
+        groups=args.group,
+        purposes=args.purposes,
+        clients=args.client,
+        shard=shard,
+        num_shards=num_shards,
+        balance=args.balance,
+        )
+  except (ValueError, IOError) as e:
+    sys.stderr.write('dumplist: error: %s\n' % e)
+    return 2
 
   output = sys.stdout
   if args.selftest:
@@ -43,16 +71,9 @@ def add_command(subparsers):
 
   parser = subparsers.add_parser('dumplist', help=dumplist.__doc__)
 
-  from .query import Database
-
-  db = Database()
-
-  if not db.is_valid():
-    protocols = ('waiting','for','database','creation')
-    clients = tuple()
-  else:
-    protocols = [k.name for k in db.protocols()]
-    clients = [k.id for k in db.clients()]
+  # choices come from the model definitions: building the parser must not
+  # open the database
+  from .models import Client, File
 
   parser.add_argument('-d', '--directory', dest="directory", default='',
                       help="if given, this path will be prepended to every entry returned (defaults to '%(default)s')")
@@ -60,18 +81,25 @@ def add_command(subparsers):
                       help="if given, this extension will be appended to every entry returned (defaults to '%(default)s')")
   parser.add_argument('-c', '--purpose', dest="purposes", default=None,
                       help="if given, limits the dump to a particular subset of the data that corresponds to the "
-                           "given purpose (defaults to '%(default)s')", choices=db.purposes())
+                           "given purpose (defaults to '%(default)s')", choices=File.purpose_choices)
   parser.add_argument('-g', '--group', dest="group", default=None,
                       help="if given, this value will limit the output files to those belonging to a particular "
-                           "protocol group. (defaults to '%(default)s')", choices=db.groups())
+                           "protocol group. (defaults to '%(default)s')", choices=Client.group_choices)
   parser.add_argument('-a', '--attacks', dest="attacks", default=None,
                       help="if given, this value will limit the output files to those using this type of attack. "
-                           "(defaults to '%(default)s')", choices=db.attack_supports())
+                           "(defaults to '%(default)s')", choices=File.attack_choices)
   parser.add_argument('-x', '--protocol', dest="protocol", default=None,
                       help="if given, this value will limit the output files to those for a given protocol. "
-                           "(defaults to '%(default)s')", choices=protocols)
+                           "(defaults to '%(default)s')")
   parser.add_argument('-C', '--client', dest="client", default=None, type=str,
-                      help="if given, limits the dump to a particular client (defaults to '%(default)s')", choices=clients)
+                      help="if given, limits the dump to a particular client (defaults to '%(default)s')")
+  parser.add_argument('-s', '--shard', dest="shard", default=None, type=shard_spec, metavar='I/N',
+                      help="if given, only dumps the I-th of N disjoint shards of the list, counting from 0, "
+                           "for instance to split it among the tasks of an array job (defaults to all)")
+  parser.add_argument('-b', '--balance', dest="balance", default='count', choices=balance_choices,
+                      help="how shards are balanced: by number of files, by total audio duration, as stored by "
+                           "'create --audiodir', or by total file size, in which case the audio files are looked up "
+                           "in --directory (defaults to '%(default)s')")
   parser.add_argument('--self-test', dest="selftest", default=False, action='store_true', help=SUPPRESS)
 
   parser.set_defaults(func=dumplist) #action
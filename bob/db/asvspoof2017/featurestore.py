@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""A sharded store for arrays computed from the files of the database.
+
+Saving one HDF5 file per utterance and feature type creates ~100k tiny files.
+:py:class:`FeatureStore` instead appends the arrays, keyed by
+:py:attr:`.File.id`, to a few large shard files, each with a small index of
+fixed-size records. Several processes may append to the same store
+concurrently, and arrays are read through memory maps.
+"""
+
+import os
+import json
+import threading
+
+import numpy
+
+
+VERSION = 1
+"""The version of the store layout"""
+
+MAX_DIMS = 8
+"""The maximum number of dimensions of the stored arrays"""
+
+RECORD_DTYPE = numpy.dtype([
+    ('id', '<i8'),
+    ('offset', '<i8'),  # in bytes, from the start of the shard
+    ('nbytes', '<i8'),
+    ('dtype', 'S8'),
+    ('ndim', '<i8'),
+    ('shape', '<i8', (MAX_DIMS,)),
+])
+"""The layout of the index records, one per stored array"""
+
+ALIGNMENT = 16
+"""Arrays start at a multiple of this many bytes in their shard"""
+
+
+class FeatureStore(object):
+    """Stores arrays in a few shard files, indexed by file id
+
+    Keyword parameters:
+
+    directory
+        The directory of the store. It is created if it does not exist.
+
+    num_shards
+        The number of shards of a new store. An existing store keeps the
+        number it was created with.
+
+    Arrays are saved with ``store.save(id, data)`` (or :py:meth:`.File.save`
+    with ``store=store``) and read back with ``store.load(id)`` (or
+    :py:meth:`.File.load`). Saving an id again replaces its array. Appends are
+    serialized with a lock on each shard, so that processes can share a store.
+    Loaded arrays are read-only views of the memory-mapped shards.
+    """
+
+    def __init__(self, directory, num_shards=16):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+        meta = os.path.join(directory, 'store.json')
+        if not os.path.exists(meta):
+            tmpfile = '%s.%d.%d.tmp' % (meta, os.getpid(), threading.current_thread().ident)
+            with open(tmpfile, 'w') as f:
+                json.dump(dict(version=VERSION, num_shards=num_shards), f)
+            try:
+                # only the first of several concurrent creators wins
+                os.link(tmpfile, meta)
+            except OSError:
+                pass
+            os.unlink(tmpfile)
+
+        with open(meta) as f:
+            info = json.load(f)
+        if info['version'] != VERSION:
+            raise IOError("The store at `%s' has version %d, but version %d is supported" %
+                          (directory, info['version'], VERSION))
+        self.num_shards = info['num_shards']
+
+        self.m_index = [{} for _ in range(self.num_shards)]  # per shard: id -> record
+        self.m_read = [0] * self.num_shards  # per shard: number of records read
+        self.m_maps = [None] * self.num_shards
+
+    def _path(self, shard, extension):
+        return os.path.join(self.directory, 'shard-%03d%s' % (shard, extension))
+
+    def shard(self, id):
+        """Returns the shard in which the array of the given id is stored"""
+
+        return int(id) % self.num_shards
+
+    def save(self, id, data):
+        """Appends the given array to the store, under the given file id"""
+
+        import fcntl
+
+        data = numpy.asarray(data, order='C')
+        if data.ndim > MAX_DIMS:
+            raise ValueError("Arrays with more than %d dimensions cannot be stored" % MAX_DIMS)
+        if data.dtype.hasobject:
+            raise ValueError("Arrays of Python objects cannot be stored")
+
+        record = numpy.zeros(1, dtype=RECORD_DTYPE)
+        record['id'] = id
+        record['nbytes'] = data.nbytes
+        record['dtype'] = data.dtype.str.encode('ascii')
+        record['ndim'] = data.ndim
+        record['shape'][0, :data.ndim] = data.shape
+
+        shard = self.shard(id)
+        with open(self._path(shard, '.bin'), 'ab') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                offset = f.seek(0, os.SEEK_END)
+                padding = -offset % ALIGNMENT
+                f.write(b'\0' * padding)
+                record['offset'] = offset + padding
+                f.write(data.tobytes())
+                f.flush()
+                # the record is only written once its data is complete
+                with open(self._path(shard, '.idx'), 'ab') as index:
+                    index.write(record.tobytes())
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _refresh(self, shard):
+        """Reads the index records appended to a shard since the last call"""
+
+        path = self._path(shard, '.idx')
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return
+        if size < (self.m_read[shard] + 1) * RECORD_DTYPE.itemsize:
+            return
+        with open(path, 'rb') as f:
+            f.seek(self.m_read[shard] * RECORD_DTYPE.itemsize)
+            chunk = f.read()
+        # ignores a record being written
+        records = numpy.frombuffer(chunk[:len(chunk) - len(chunk) % RECORD_DTYPE.itemsize], dtype=RECORD_DTYPE)
+        index = self.m_index[shard]
+        for record in records:
+            index[int(record['id'])] = record
+        self.m_read[shard] += len(records)
+
+    def _record(self, id):
+        # arrays saved since, possibly by other processes, replace known ones
+        shard = self.shard(id)
+        self._refresh(shard)
+        return shard, self.m_index[shard].get(int(id))
+
+    def __contains__(self, id):
+        return self._record(id)[1] is not None
+
+    def ids(self):
+        """Returns the sorted ids of all arrays in the store"""
+
+        for shard in range(self.num_shards):
+            self._refresh(shard)
+        return sorted(k for index in self.m_index for k in index)
+
+    def load(self, id):
+        """Returns the array stored for the given file id, as a read-only view of
+        the memory-mapped shard. Raises a :py:exc:`KeyError` if there is none."""
+
+        shard, record = self._record(id)
+        if record is None:
+            raise KeyError("There is no array for file id %d in the store at `%s'" % (id, self.directory))
+
+        end = int(record['offset']) + int(record['nbytes'])
+        shape = tuple(record['shape'][:int(record['ndim'])])
+        dtype = record['dtype'].decode('ascii')
+        if not end:
+            # empty arrays at the start of a shard, which may be an empty file
+            # that cannot be mapped
+            data = numpy.empty(shape, dtype=dtype)
+            data.flags.writeable = False
+            return data
+
+        data = self.m_maps[shard]
+        if data is None or len(data) < end:
+            # maps the shard again, as it grew since it was mapped
+            data = self.m_maps[shard] = numpy.memmap(self._path(shard, '.bin'), dtype=numpy.uint8, mode='r')
+        return data[int(record['offset']):end].view(dtype).reshape(shape)
@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""A columnar, in-memory index of the ASVspoof2017 file metadata.
+
+The whole corpus is small enough (~19k files) to be kept in memory as a
+handful of NumPy arrays. Enumerated columns are stored as small integer codes
+into the ``*_choices`` tuples of the model classes, so that the filters of
+:py:meth:`.Database.objects` become vectorized boolean masks.
+"""
+
+import os
+
+import numpy
+
+from .models import Client, ClientRecord, File, FileRecord, Protocol, ProtocolFiles, ProtocolRecord
+
+
+SNAPSHOT_VERSION = 1
+"""The version of the snapshot layout written by :py:meth:`ColumnarIndex.save`"""
+
+
+def snapshot_path(sqlite_file):
+    """Returns the path of the metadata snapshot kept next to the given
+    database file"""
+
+    return os.path.splitext(sqlite_file)[0] + '.npz'
+
+
+class ColumnarIndex(object):
+    """Keeps the metadata of all files as NumPy arrays, sorted by file path.
+
+    Keyword parameters:
+
+    ids
+        The :py:attr:`.File.id` of every file, as an integer array.
+
+    paths
+        The :py:attr:`.File.path` of every file, as a unicode array.
+
+    columns
+        A dictionary mapping each name in :py:attr:`ColumnarIndex.enums` to an
+        array of codes into the corresponding choices.
+
+    clients
+        A tuple with all client identifiers (sorted). ``columns['client']``
+        holds indexes into this tuple.
+
+    client_gender, client_group
+        Per-client arrays with codes into :py:attr:`.Client.gender_choices` and
+        :py:attr:`.Client.group_choices`.
+
+    protocols
+        A tuple with all protocol names.
+
+    protocol_mask
+        A boolean array of shape ``(len(protocols), len(ids))`` telling which
+        files are part of which protocol.
+
+    protocol_ids
+        The :py:attr:`.Protocol.id` of each protocol. Defaults to their
+        position, starting at 1.
+
+    durations
+        The :py:attr:`.File.duration` of every file, ``NaN`` if unknown.
+        Defaults to all unknown.
+
+    samples
+        The :py:attr:`.File.samples` of every file, ``-1`` if unknown.
+        Defaults to all unknown.
+    """
+
+    enums = (
+        ('group', File.group_choices),
+        ('purpose', File.purpose_choices),
+        ('attacktype', File.attack_choices),
+        ('common_phrase', File.common_phrase_choices),
+        ('environment', File.environment_choices),
+        ('playback_device', File.playback_device_choices),
+        ('recording_device', File.recording_device_choices),
+    )
+    """The enumerated file columns and their possible values"""
+
+    def __init__(self, ids, paths, columns, clients, client_gender, client_group, protocols, protocol_mask,
+                 protocol_ids=None, durations=None, samples=None):
+        self.ids = ids
+        self.paths = paths
+        self.columns = columns
+        self.clients = clients
+        self.client_gender = client_gender
+        self.client_group = client_group
+        self.protocols = protocols
+        self.protocol_mask = protocol_mask
+        if protocol_ids is None:
+            protocol_ids = numpy.arange(1, len(protocols) + 1)
+        self.protocol_ids = protocol_ids
+        if durations is None:
+            durations = numpy.full(len(ids), numpy.nan)
+        self.durations = durations
+        if samples is None:
+            samples = numpy.full(len(ids), -1, dtype=numpy.int64)
+        self.samples = samples
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def from_session(cls, session):
+        """Loads the index from an open database session, using two plain
+        queries (no ORM object is created)"""
+
+        clients = session.query(Client.id, Client.gender, Client.group).order_by(Client.id).all()
+        client_code = dict((c[0], i) for i, c in enumerate(clients))
+        client_gender = numpy.array([Client.gender_choices.index(c[1]) for c in clients], dtype=numpy.uint8)
+        client_group = numpy.array([Client.group_choices.index(c[2]) for c in clients], dtype=numpy.uint8)
+
+        names = [k for k, _ in cls.enums]
+        rows = session.query(File.id, File.path, File.client_id, File.duration, File.samples,
+                             *[getattr(File, k) for k in names]). \
+            join(Client).order_by(File.path).all()
+
+        ids = numpy.array([r[0] for r in rows], dtype=numpy.int64)
+        paths = numpy.array([r[1] for r in rows], dtype=numpy.str_)
+        columns = {'client': numpy.array([client_code[r[2]] for r in rows], dtype=numpy.int32)}
+        for i, (name, choices) in enumerate(cls.enums):
+            code = dict((v, j) for j, v in enumerate(choices))
+            columns[name] = numpy.array([code[r[5 + i]] for r in rows], dtype=numpy.uint8)
+        durations = numpy.array([numpy.nan if r[3] is None else r[3] for r in rows], dtype=numpy.float64)
+        samples = numpy.array([-1 if r[4] is None else r[4] for r in rows], dtype=numpy.int64)
+
+        protocol_rows = session.query(Protocol.id, Protocol.name).order_by(Protocol.id).all()
+        protocols = tuple(p[1] for p in protocol_rows)
+        position = dict((int(k), i) for i, k in enumerate(ids))
+        protocol_mask = numpy.zeros((len(protocols), len(ids)), dtype=bool)
+        for name, file_id in session.query(Protocol.name, ProtocolFiles.file_id).join(ProtocolFiles.protocol):
+            i = position.get(int(file_id))
+            if i is not None:
+                protocol_mask[protocols.index(name), i] = True
+
+        return cls(ids, paths, columns, tuple(c[0] for c in clients), client_gender, client_group,
+                   protocols, protocol_mask, numpy.array([p[0] for p in protocol_rows], dtype=numpy.int64),
+                   durations, samples)
+
+    def save(self, filename):
+        """Writes the index to a versioned NumPy ``.npz`` snapshot, which
+        :py:meth:`ColumnarIndex.load` reads back without any database access.
+        The file is replaced atomically."""
+
+        arrays = dict(
+            version=SNAPSHOT_VERSION,
+            ids=self.ids,
+            paths=self.paths,
+            clients=numpy.array(self.clients, dtype=numpy.str_),
+            client_gender=self.client_gender,
+            client_group=self.client_group,
+            protocols=numpy.array(self.protocols, dtype=numpy.str_),
+            protocol_mask=self.protocol_mask,
+            protocol_ids=self.protocol_ids,
+            durations=self.durations,
+            samples=self.samples,
+        )
+        for name, values in self.columns.items():
+            arrays['column_' + name] = values
+
+        tmpfile = '%s.%d.tmp.npz' % (filename, os.getpid())
+        try:
+            numpy.savez(tmpfile, **arrays)
+            os.replace(tmpfile, filename)
+        except BaseException:
+            if os.path.exists(tmpfile): os.unlink(tmpfile)
+            raise
+
+    @classmethod
+    def load(cls, filename):
+        """Reads an index written by :py:meth:`ColumnarIndex.save`"""
+
+        with numpy.load(filename) as npz:
+            if int(npz['version']) != SNAPSHOT_VERSION:
+                raise IOError("The snapshot `%s' has version %d, but version %d is supported" %
+                              (filename, int(npz['version']), SNAPSHOT_VERSION))
+            columns = dict((k[len('column_'):], npz[k]) for k in npz.files if k.startswith('column_'))
+            return cls(npz['ids'], npz['paths'], columns, tuple(npz['clients'].tolist()),
+                       npz['client_gender'], npz['client_group'], tuple(npz['protocols'].tolist()),
+                       npz['protocol_mask'], npz['protocol_ids'],
+                       npz['durations'] if 'durations' in npz.files else None,
+                       npz['samples'] if 'samples' in npz.files else None)
+
+    def _lookup(self, values, choices):
+        """Returns a boolean lookup table over the codes of ``choices`` which is
+        set for the given values"""
+
+        table = numpy.zeros(len(choices), dtype=bool)
+        for v in values:
+            if v in choices:
+                table[choices.index(v)] = True
+        return table
+
+    def select(self, protocol, groups=None, purposes=None, attacks=None, gender=None, clients=None):
+        """Returns the positions (in path order) of the files matching the
+        given, already validated, filters. Filters set to ``None`` or empty are
+        not applied, except for ``protocol`` which is mandatory."""
+
+        mask = numpy.zeros(len(self.ids), dtype=bool)
+        for name in protocol:
+            if name in self.protocols:
+                mask |= self.protocol_mask[self.protocols.index(name)]
+
+        # client-based filters are first resolved on the (few) clients
+        client_ok = numpy.ones(len(self.clients), dtype=bool)
+        if groups:
+            client_ok &= self._lookup(groups, Client.group_choices)[self.client_group]
+        if clients:
+            client_ok &= self._lookup(clients, self.clients)
+        if gender:
+            client_ok &= self._lookup(gender, Client.gender_choices)[self.client_gender]
+        if not client_ok.all():
+            mask &= client_ok[self.columns['client']]
+
+        if attacks:
+            mask &= self._lookup(attacks, File.attack_choices)[self.columns['attacktype']]
+        if purposes:
+            mask &= self._lookup(purposes, File.purpose_choices)[self.columns['purpose']]
+
+        return numpy.flatnonzero(mask)
+
+    def lookup(self, paths):
+        """Returns the positions of the files with the given paths, ``-1`` for
+        the paths which are not in the index"""
+
+        paths = numpy.array(list(paths), dtype=numpy.str_)
+        if not len(self.paths):
+            return numpy.full(len(paths), -1)
+        rows = numpy.searchsorted(self.paths, paths)
+        rows[rows == len(self.paths)] = 0
+        return numpy.where(self.paths[rows] == paths, rows, -1)
+
+    def client_records(self, groups=None, gender=None):
+        """Returns :py:class:`.ClientRecord` objects for the clients of the
+        given groups and genders, sorted by id"""
+
+        ok = numpy.ones(len(self.clients), dtype=bool)
+        if groups:
+            ok &= self._lookup(groups, Client.group_choices)[self.client_group]
+        if gender:
+            ok &= self._lookup(gender, Client.gender_choices)[self.client_gender]
+        return [ClientRecord(self.clients[i], Client.gender_choices[self.client_gender[i]],
+                             Client.group_choices[self.client_group[i]]) for i in numpy.flatnonzero(ok).tolist()]
+
+    def protocol_records(self):
+        """Returns :py:class:`.ProtocolRecord` objects for all protocols"""
+
+        return [ProtocolRecord(int(k), v) for k, v in zip(self.protocol_ids, self.protocols)]
+
+    def records(self, rows):
+        """Returns :py:class:`.FileRecord` objects for the given positions,
+        without any database access"""
+
+        columns = {
+            'id': self.ids[rows].tolist(),
+            'path': self.paths[rows].tolist(),
+            'client_id': [self.clients[k] for k in self.columns['client'][rows].tolist()],
+        }
+        for name, choices in self.enums:
+            columns[name] = [choices[k] for k in self.columns[name][rows].tolist()]
+
+        return [FileRecord(*k) for k in zip(*[columns[f] for f in FileRecord._fields])]
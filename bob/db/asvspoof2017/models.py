@@ -7,7 +7,8 @@
 """
 
 import os
-from sqlalchemy import Table, Column, Integer, String, ForeignKey
+import collections
+from sqlalchemy import Table, Column, Integer, Float, String, ForeignKey, Index
 from bob.db.base.sqlalchemy_migration import Enum, relationship
 from sqlalchemy.orm import backref
 from sqlalchemy.ext.declarative import declarative_base
@@ -23,6 +24,9 @@ class Client(Base):
     to"""
 
     __tablename__ = 'client'
+    __table_args__ = (
+        Index('ix_client_group_gender', 'group', 'gender'),
+    )
 
     gender_choices = ('male', 'female', 'undefined')
     """Male or female speech"""
@@ -53,6 +57,9 @@ class Protocol(Base):
     to"""
 
     __tablename__ = 'protocol'
+    __table_args__ = (
+        Index('ix_protocol_name', 'name'),
+    )
 
     id = Column(Integer, primary_key=True)
     """Key identifier for Protocols"""
@@ -71,6 +78,11 @@ class File(Base, bob.db.base.File):
     """Generic file container"""
 
     __tablename__ = 'file'
+    __table_args__ = (
+        # match the filters applied by Database.objects()
+        Index('ix_file_purpose_attacktype', 'purpose', 'attacktype'),
+        Index('ix_file_client', 'client_id'),
+    )
 
     group_choices = ('train', 'dev', 'eval')
     """Possible groups of this file"""
@@ -125,6 +137,21 @@ class File(Base, bob.db.base.File):
     client_id = Column(String, ForeignKey('client.id'))  # for SQL
     """The client identifier to which this file is bound to"""
 
+    source = Column(String(100))
+    """The name of the protocol file listing this file, see :py:class:`Source`"""
+
+    # the audio columns are left empty in databases migrated from an older
+    # version of this package, until ``create --update --audiodir`` fills them
+    rate = Column(Integer)
+    """The sampling rate of the audio file, in Hz, if read at creation time"""
+
+    samples = Column(Integer)
+    """The number of samples (per channel) of the audio file, if read at
+    creation time"""
+
+    duration = Column(Float)
+    """The duration of the audio file, in seconds, if read at creation time"""
+
     # for Python
     client = relationship(Client, backref=backref('files', order_by=id))
     """A direct link to the client object that this file belongs to"""
@@ -178,6 +205,23 @@ class File(Base, bob.db.base.File):
 
         return self.make_path(directory, '.wav')
 
+    def audio_memmap(self, directory=None):
+        """Maps the samples of the database audio file for this object in memory
+
+        Keyword parameters:
+
+        directory
+            An optional directory name that will be prefixed to the audio file path.
+
+        Returns a read-only :py:class:`numpy.memmap` of shape ``(channels,
+        samples)``, with the sampling rate and the number of channels as its
+        ``rate`` and ``channels`` attributes. Samples are only read when
+        accessed (see :py:func:`.audio.wav_memmap`).
+        """
+
+        from .audio import wav_memmap
+        return wav_memmap(self.audiofile(directory))
+
     def is_real(self):
         """Returns True if this file is real data, False otherwise"""
 
@@ -188,7 +232,7 @@ class File(Base, bob.db.base.File):
 
         return self.purpose == 'spoof'
 
-    def load(self, directory=None, extension='.hdf5'):
+    def load(self, directory=None, extension='.hdf5', store=None):
         """Loads the data at the specified location and using the given extension.
 
         Keyword parameters:
@@ -203,10 +247,17 @@ class File(Base, bob.db.base.File):
         extension
             [optional] The extension of the filename - this will control the type of
             output and the codec for saving the input blob.
+
+        store
+            [optional] A :py:class:`.featurestore.FeatureStore` to read the data
+            from, by file id, instead of a file of its own. ``directory`` and
+            ``extension`` are then ignored.
         """
+        if store is not None:
+            return store.load(self.id)
         return bob.io.base.load(self.make_path(directory, extension))
 
-    def save(self, data, directory=None, extension='.hdf5'):
+    def save(self, data, directory=None, extension='.hdf5', store=None):
         """Saves the input data at the specified location and using the given
         extension.
 
@@ -222,29 +273,78 @@ class File(Base, bob.db.base.File):
         extension
             [optional] The extension of the filename - this will control the type of
             output and the codec for saving the input blob.
+
+        store
+            [optional] A :py:class:`.featurestore.FeatureStore` to append the
+            data to, by file id, instead of writing a file of its own.
+            ``directory`` and ``extension`` are then ignored.
         """
 
+        if store is not None:
+            return store.save(self.id, data)
+
         path = self.make_path(directory, extension)
         bob.io.base.create_directories_safe(os.path.dirname(path))
         bob.io.base.save(data, path)
 
+class FileRecord(collections.namedtuple('FileRecord', ('id', 'path', 'purpose', 'attacktype', 'common_phrase',
+                                                        'environment', 'playback_device', 'recording_device',
+                                                        'client_id', 'group'))):
+    """A lightweight, read-only copy of a :py:class:`File`, as returned by
+    :py:meth:`.Database.records`.
+
+    It is a plain tuple with named fields. It is not bound to a database session
+    and has no ``client`` relationship, but provides the same helpers as
+    :py:class:`File`.
+    """
+
+    __slots__ = ()
+
+    make_path = File.make_path
+    audiofile = File.audiofile
+    audio_memmap = File.audio_memmap
+    is_real = File.is_real
+    is_attack = File.is_attack
+    load = File.load
+    save = File.save
+
+
+class ClientRecord(collections.namedtuple('ClientRecord', ('id', 'gender', 'group'))):
+    """A lightweight, read-only copy of a :py:class:`Client`, as returned by
+    :py:meth:`.Database.clients` with the ``snapshot`` backend"""
+
+    __slots__ = ()
+
+
+class ProtocolRecord(collections.namedtuple('ProtocolRecord', ('id', 'name'))):
+    """A lightweight, read-only copy of a :py:class:`Protocol`, as returned by
+    :py:meth:`.Database.protocols` with the ``snapshot`` backend"""
+
+    __slots__ = ()
+
+
 class ProtocolFiles(Base):
     """Database clients, marked by an integer identifier and the set they belong
     to"""
 
     __tablename__ = 'protocolfiles'
+    __table_args__ = (
+        # both join directions: protocol to files and file to protocols
+        Index('ix_protocolfiles_protocol_file', 'protocol_id', 'file_id'),
+        Index('ix_protocolfiles_file_protocol', 'file_id', 'protocol_id'),
+    )
 
     id = Column(Integer, primary_key=True)
     """Key identifier for Protocols"""
 
-    protocol_id = Column(String, ForeignKey('protocol.id'))  # for SQL
+    protocol_id = Column(Integer, ForeignKey('protocol.id'))  # for SQL
     """The protocol identifier that the file is linked to"""
 
     # for Python
     protocol = relationship(Protocol, backref=backref('protocolfiles', order_by=id))
     """A direct link to the protocol object that refers to the given file"""
 
-    file_id = Column(String, ForeignKey('file.id'))  # for SQL
+    file_id = Column(Integer, ForeignKey('file.id'))  # for SQL
     """The file id that the protocol references"""
 
     # for Python
@@ -259,3 +359,52 @@ class ProtocolFiles(Base):
     def __repr__(self):
         return "ProtocolFiles('%s, %s')" % (self.protocol_id, self.file_id)
 
+
+
+class Source(Base):
+    """The protocol files from which the database was created, with a
+    fingerprint of their contents, so that ``create --update`` only applies the
+    changes of the files modified since"""
+
+    __tablename__ = 'source'
+
+    id = Column(Integer, primary_key=True)
+    """Key identifier for sources"""
+
+    filename = Column(String(100), unique=True)
+    """The name of the protocol file, without its directory"""
+
+    group = Column(String(20))
+    """The group of the files listed in the protocol file"""
+
+    checksum = Column(String(64))
+    """The SHA-256 digest of the protocol file contents"""
+
+    def __init__(self, filename, group, checksum):
+        self.filename = filename
+        self.group = group
+        self.checksum = checksum
+
+    def __repr__(self):
+        return "Source('%s', '%s')" % (self.filename, self.checksum)
+
+
+def missing_columns(connection):
+    """Returns the columns of the models which the tables of a database lack,
+    as ``table.column`` names, for databases created by an older version of
+    this package. Tables which do not exist are not reported.
+
+    Keyword parameters:
+
+    connection
+        An SQLAlchemy connection or session to the database.
+    """
+
+    from sqlalchemy import text
+
+    missing = []
+    for table in Base.metadata.sorted_tables:
+        names = set(k[1] for k in connection.execute(text('PRAGMA table_info("%s")' % table.name)))
+        if names:
+            missing.extend('%s.%s' % (table.name, k.name) for k in table.columns if k.name not in names)
+    return missing
@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""Packs the audio samples of the whole database into a single file.
+
+Reading ~19k small WAV files is dominated by the cost of opening them. The
+packed archive keeps the samples of all files one after the other in a single
+binary file, and a table with the position and format of each file, indexed by
+:py:attr:`.File.id`. :py:class:`PackedAudio` maps the archive in memory and
+returns the samples of any file without copying them.
+"""
+
+import os
+import sys
+
+import numpy
+
+
+VERSION = 2
+"""The version of the archive layout"""
+
+INDEX_DTYPE = numpy.dtype([
+    ('id', '<i8'),
+    ('offset', '<i8'),  # in bytes, from the start of the archive
+    ('frames', '<i8'),
+    ('rate', '<i4'),
+    ('channels', '<i2'),
+    ('bits', '<i2'),
+    ('format', '<i2'),
+])
+"""The layout of the index table, one row per file"""
+
+ALIGNMENT = 16
+"""The samples of each file start at a multiple of this many bytes"""
+
+TOKEN_SIZE = 16
+"""The size of the random token ending the archive, which its index records"""
+
+
+def index_path(filename):
+    """Returns the path of the index table for the given archive"""
+
+    return filename + '.index.npz'
+
+
+def pack_audio(ids, paths, filename, num_workers=8, chunk=64):
+    """Writes the samples of the given WAV files into a packed archive
+
+    Keyword parameters:
+
+    ids
+        The :py:attr:`.File.id` of each file.
+
+    paths
+        The path to each WAV file.
+
+    filename
+        The archive to write. The index table is written next to it (see
+        :py:func:`index_path`). Each file is replaced atomically, the archive
+        first. The index records the size of the archive and a random token
+        written at its end, so that :py:class:`PackedAudio` detects an index
+        left from another archive by an interrupted run.
+
+    num_workers
+        The number of threads reading files in parallel.
+
+    chunk
+        How many files are read ahead of the writer.
+
+    Returns the index table, a NumPy array of :py:data:`INDEX_DTYPE`.
+    """
+
+    from concurrent.futures import ThreadPoolExecutor
+    from .audio import wav_info, is_truncated
+
+    def read(path):
+        info = wav_info(path)
+        if is_truncated(path, info):
+            raise IOError("`%s' is truncated: the header declares %d bytes of samples" % (path, info.size))
+        size = info.nframes * info.frame_size
+        with open(path, 'rb') as f:
+            f.seek(info.offset)
+            return info, f.read(size)
+
+    ids = list(ids)
+    paths = list(paths)
+    index = numpy.zeros(len(paths), dtype=INDEX_DTYPE)
+
+    tmpfile = '%s.%d.tmp' % (filename, os.getpid())
+    tmpindex = '%s.%d.tmp.npz' % (filename, os.getpid())
+    token = os.urandom(TOKEN_SIZE)
+    offset = 0
+    try:
+        with open(tmpfile, 'wb') as out, ThreadPoolExecutor(max_workers=max(1, num_workers)) as pool:
+            for start in range(0, len(paths), chunk):
+                for i, (info, data) in enumerate(pool.map(read, paths[start:start + chunk]), start):
+                    padding = -offset % ALIGNMENT
+                    out.write(b'\0' * padding)
+                    offset += padding
+                    index[i] = (ids[i], offset, info.nframes, info.rate, info.channels, info.bits, info.format)
+                    out.write(data)
+                    offset += len(data)
+            out.write(token)
+        numpy.savez(tmpindex, index=index, version=VERSION, size=offset + TOKEN_SIZE,
+                    token=numpy.frombuffer(token, dtype=numpy.uint8))
+    except BaseException:
+        for k in (tmpfile, tmpindex):
+            if os.path.exists(k): os.unlink(k)
+        raise
+
+    os.replace(tmpfile, filename)
+    os.replace(tmpindex, index_path(filename))
+    return index
+
+
+class PackedAudio(object):
+    """Reads the samples of files in an archive written by :py:func:`pack_audio`
+
+    Keyword parameters:
+
+    filename
+        The archive file. It is memory-mapped once: the samples are only read
+        from disk when accessed.
+
+    The samples of a file are obtained by its id with ``archive[id]``, as a
+    read-only array of shape ``(channels, samples)`` that shares its memory
+    with the archive.
+    """
+
+    def __init__(self, filename):
+        with numpy.load(index_path(filename)) as npz:
+            if int(npz['version']) != VERSION:
+                raise IOError("The archive `%s' has version %d, but version %d is supported" %
+                              (filename, int(npz['version']), VERSION))
+            self.index = npz['index']
+            size, token = int(npz['size']), npz['token'].tobytes()
+        self.filename = filename
+        self.m_rows = dict((k, i) for i, k in enumerate(self.index['id'].tolist()))
+        self.m_data = numpy.memmap(filename, dtype=numpy.uint8, mode='r')
+        if len(self.m_data) != size or self.m_data[-TOKEN_SIZE:].tobytes() != token:
+            raise IOError("The index of the archive `%s' describes another archive: pack it again" % filename)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, id):
+        return id in self.m_rows
+
+    def ids(self):
+        """Returns the ids of all files in the archive"""
+
+        return self.index['id'].tolist()
+
+    def rate(self, id):
+        """Returns the sampling rate, in Hz, of the given file"""
+
+        return int(self.index['rate'][self.m_rows[id]])
+
+    def __getitem__(self, id):
+        from .audio import WavInfo
+
+        row = self.index[self.m_rows[id]]
+        channels = int(row['channels'])
+        info = WavInfo(int(row['rate']), channels, int(row['bits']), int(row['format']), 0, 0)
+        size = int(row['frames']) * info.frame_size
+        start = int(row['offset'])
+        return self.m_data[start:start + size].view(info.dtype).reshape(-1, channels).T
+
+
+# Driver API
+# ==========
+
+def pack(args):
+    """Packs the audio files of the database into a single archive"""
+
+    import time
+    from .query import Database
+    db = Database()
+
+    try:
+        r = db.records(
+            protocol=args.protocol,
+            groups=args.group,
+            purposes=args.purposes,
+        )
+    except ValueError as e:
+        sys.stderr.write('pack: error: %s\n' % e)
+        return 2
+
+    start = time.time()
+    index = pack_audio([k.id for k in r], db.make_paths(r, args.directory, args.extension), args.output,
+                       num_workers=args.workers)
+
+    output = sys.stdout
+    if args.selftest:
+        from bob.db.base.utils import null
+        output = null()
+
+    output.write('Packed %d files (%d samples) into "%s" in %.2f seconds\n' %
+                 (len(index), index['frames'].sum(), args.output, time.time() - start))
+
+    return 0
+
+
+def add_command(subparsers):
+    """Add specific subcommands that the action "pack" can use"""
+
+    from argparse import SUPPRESS
+    from .models import Client, File
+
+    parser = subparsers.add_parser('pack', help=pack.__doc__)
+
+    parser.add_argument('output', metavar='FILE',
+                        help="the archive to write; its index is written to FILE.index.npz")
+    parser.add_argument('-d', '--directory', dest="directory", default='',
+                        help="the directory containing the audio files (defaults to '%(default)s')")
+    parser.add_argument('-e', '--extension', dest="extension", default='.wav',
+                        help="the extension of the audio files (defaults to '%(default)s')")
+    parser.add_argument('-c', '--purpose', dest="purposes", default=None,
+                        help="if given, only packs the files with the given purpose (defaults to all)",
+                        choices=File.purpose_choices)
+    parser.add_argument('-g', '--group', dest="group", default=None,
+                        help="if given, only packs the files of the given group (defaults to all)",
+                        choices=Client.group_choices)
+    parser.add_argument('-x', '--protocol', dest="protocol", default=None,
+                        help="if given, only packs the files of the given protocol (defaults to '%(default)s')")
+    parser.add_argument('-j', '--workers', dest="workers", default=8, type=int,
+                        help="the number of threads reading files in parallel (defaults to '%(default)s')")
+    parser.add_argument('--self-test', dest="selftest", default=False,
+                        action='store_true', help=SUPPRESS)
+
+    parser.set_defaults(func=pack)  # action
@@ -7,14 +7,128 @@
 asvspoof2017 attack database in the most obvious ways.
 """
 
+import os
+import types
+import threading
+import weakref
+import collections
+
 from .models import *
-from .driver import Interface
+from .index import ColumnarIndex, snapshot_path
 
 import bob.db.base
 
-INFO = Interface()
+SQLITE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'db.sql3')
+"""The database file, shipped within this package"""
+
+
+def join_paths(paths, directory=None, extension=None):
+    """Joins many path stems with the same directory and extension, as
+    :py:meth:`.File.make_path` does for a single one"""
+
+    if not extension: extension = ''
+    if not directory:
+        return [str(p + extension) for p in paths]
+    head = os.path.join(directory, '')
+    return [str(head + p + extension if not p.startswith(os.sep) else os.path.join(directory, p + extension))
+            for p in paths]
+
+
+def _save_array(data, path):
+    """Saves one array with :py:func:`bob.io.base.save` (in a worker)"""
+
+    import bob.io.base
+    bob.io.base.save(data, path)
+    return path
+
+
+def partition(weights, num_shards):
+    """Assigns items to shards, so that the shards have about the same total
+    weight
+
+    Keyword parameters:
+
+    weights
+        The weight of each item, for example its duration.
+
+    num_shards
+        The number of shards.
+
+    Returns a NumPy array with the shard of each item. Items are assigned
+    greedily, heaviest first, to the lightest shard so far: the assignment only
+    depends on the weights and their order.
+    """
+
+    import heapq
+    import numpy
+
+    weights = numpy.asarray(weights, dtype=numpy.float64)
+    shards = numpy.empty(len(weights), dtype=numpy.int64)
+    heap = [(0.0, k) for k in range(num_shards)]
+    # a stable sort: ties are broken by position
+    for i in numpy.argsort(-weights, kind='mergesort').tolist():
+        total, k = heapq.heappop(heap)
+        shards[i] = k
+        heapq.heappush(heap, (total + weights[i], k))
+    return shards
+
+
+def length_batches(lengths, max_samples, num_buckets=10, shuffle=False, seed=0):
+    """Groups items of similar length into batches of a bounded padded size
+
+    Keyword parameters:
 
-SQLITE_FILE = INFO.files()[0]
+    lengths
+        The length of each item, for example its number of samples.
+
+    max_samples
+        The maximum size of a padded batch: its number of items times the
+        length of its longest item. An item longer than this makes a batch of
+        its own.
+
+    num_buckets
+        Items are sorted by length and split into this many buckets of about
+        the same number of items. Batches never mix items of two buckets.
+
+    shuffle
+        If set, the items of each bucket are shuffled before being batched, and
+        the batches are returned in random order. Otherwise, batches come from
+        the shortest items to the longest.
+
+    seed
+        The seed of the shuffling: the same seed gives the same batches.
+
+    Returns a list of batches, each a list of positions in ``lengths``.
+    """
+
+    import numpy
+
+    lengths = numpy.asarray(lengths, dtype=numpy.int64)
+    rng = numpy.random.RandomState(seed)
+    # a stable sort: ties are broken by position
+    order = numpy.argsort(lengths, kind='mergesort')
+
+    batches = []
+    for bucket in numpy.array_split(order, max(1, min(num_buckets, len(order)))):
+        if shuffle:
+            bucket = rng.permutation(bucket)
+        batch, longest = [], 0
+        for i in bucket.tolist():
+            if batch and max(longest, lengths[i]) * (len(batch) + 1) > max_samples:
+                batches.append(batch)
+                batch, longest = [], 0
+            batch.append(i)
+            longest = max(longest, lengths[i])
+        if batch:
+            batches.append(batch)
+
+    if shuffle:
+        batches = [batches[k] for k in rng.permutation(len(batches)).tolist()]
+    return batches
+
+
+CacheInfo = collections.namedtuple('CacheInfo', ('hits', 'misses', 'maxsize', 'currsize'))
+"""Statistics of the :py:meth:`Database.objects` result cache"""
 
 
 class Database(bob.db.base.SQLiteDatabase):
@@ -22,16 +136,379 @@ class Database(bob.db.base.SQLiteDatabase):
 
     It provides many different ways to probe for the characteristics of the data
     and for the data itself inside the database.
+
+    Keyword parameters:
+
+    original_directory, original_extension
+        Where the original audio files are located, and their extension.
+
+    backend
+        Either ``'sql'`` (the default), to answer every query with SQL,
+        ``'columnar'``, to load the file metadata once into a
+        :py:class:`.ColumnarIndex` and answer :py:meth:`Database.objects`
+        with vectorized masks, or ``'snapshot'``. With ``'columnar'``,
+        :py:class:`.File` objects are only loaded for the matching rows, once
+        per database instance. With ``'snapshot'``, the index is read from the
+        snapshot written by ``create`` next to the database file (or, if there
+        is none, as for a downloaded database, read once from the database
+        file), and no SQL session is kept open: :py:meth:`Database.objects`,
+        :py:meth:`Database.clients` and :py:meth:`Database.protocols` then
+        return :py:class:`.FileRecord`, :py:class:`.ClientRecord` and
+        :py:class:`.ProtocolRecord` tuples.
+
+    cache_size
+        How many :py:meth:`Database.objects` results to keep, indexed by the
+        normalized query parameters. The least recently used results are
+        dropped first. The cache is cleared when the database file is
+        modified. Set it to ``0`` to disable caching.
+
+    process_safe
+        If set, the database file is opened read-only and immutable (SQLite URI
+        ``mode=ro&immutable=1``), each thread gets its own session, and the
+        sessions are opened again in a process forked from the one which opened
+        them. A single database may then be created before starting a pool of
+        worker processes, and used from all of them::
+
+            db = Database(process_safe=True)
+
+            def work(client):
+                # runs on the session of the worker process and thread
+                return [f.id for f in db.objects(clients=client)]
+
+            with multiprocessing.Pool(64) as pool:
+                ids = pool.map(work, [c.id for c in db.clients()])
+
+        With the ``spawn`` start method, the database is pickled and opened
+        again in each worker. The database file must not be modified while it
+        is open in this mode. The ``snapshot`` backend has no session and is
+        always safe to share.
     """
 
-    def __init__(self, original_directory=None, original_extension=None):
-        # opens a session to the database - keep it open until the end
-        super(Database, self).__init__(SQLITE_FILE, File,
-                                       original_directory, original_extension)
+    backends = ('sql', 'columnar', 'snapshot')
+    """Possible query backends"""
+
+    order_choices = ('path', 'duration')
+    """Possible orders of the files returned by :py:meth:`Database.objects`"""
+
+    balance_choices = ('count', 'duration', 'size')
+    """Possible ways of balancing the shards of :py:meth:`Database.objects`"""
+
+    def __init__(self, original_directory=None, original_extension=None, backend='sql', cache_size=32,
+                 process_safe=False):
+        if backend not in self.backends:
+            raise ValueError("Unknown backend `%s', choose one of %s" % (backend, self.backends))
+        self.m_backend = backend
+        self.m_snapshot = snapshot_path(SQLITE_FILE)
+        self.m_process_safe = process_safe and backend != 'snapshot'
+        self.m_lock = threading.RLock()
+        # the base class always opens a session to the database file: its
+        # constructor is skipped, so that sessions are only opened by
+        # Database._connect, as the backend requires
+        bob.db.base.FileDatabase.__init__(self, original_directory, original_extension)
+        self.m_sqlite_file = SQLITE_FILE
+        self.m_file_class = File
+        self._connect()
+        self.m_index = None
+        # loaded objects and cached results, see Database._state
+        self.m_shared = types.SimpleNamespace()
+        self.m_local = threading.local()
+        self.m_generation = 0
+        self.m_cache_size = cache_size
+        self.m_cache_hits = 0
+        self.m_cache_misses = 0
+        self.m_cache_mtime = self._mtime()
+        self.m_vocabulary = {}
+        self._load_index()
+
+    @property
+    def m_session(self):
+        """The session to the database, or ``None`` if the database file does
+        not exist. With ``process_safe``, it is the session of the current
+        thread, opened again if the process was forked."""
+
+        if not self.__dict__.get('m_process_safe'):
+            return self.__dict__.get('_m_session')
+
+        self._check_fork()
+        if self.m_registry is None:
+            return None
+        return self.m_registry()
+
+    @m_session.setter
+    def m_session(self, value):
+        self.__dict__['_m_session'] = value
+
+    def _check_fork(self):
+        """Opens the database again in a process forked from the one which
+        opened it (``process_safe`` mode)"""
+
+        if self.m_pid != os.getpid():
+            # objects loaded before the fork are bound to the sessions of the
+            # parent process, and the lock may have been held by one of its
+            # other threads
+            self.m_lock = threading.RLock()
+            self.m_local = threading.local()
+            self._connect()
+
+    def _connect(self):
+        """Opens the database file: a read-only session, none with the
+        ``snapshot`` backend, or, with ``process_safe``, the file read-only and
+        immutable, with a scoped session for each thread"""
+
+        self.m_pid = os.getpid()
+        self.m_registry = None
+        self.m_sessions = weakref.WeakSet()
+        self.m_session = None
+        self.m_outdated = []
+        if self.m_backend == 'snapshot' or not os.path.exists(self.m_sqlite_file):
+            return
+
+        if not self.m_process_safe:
+            from bob.db.base.utils import session_try_readonly
+            self.m_session = session_try_readonly('sqlite', self.m_sqlite_file)
+            self.m_outdated = missing_columns(self.m_session)
+            return
+
+        import sqlite3
+        from sqlalchemy import create_engine
+        from sqlalchemy.orm import scoped_session, sessionmaker
+        from sqlalchemy.pool import NullPool
+        try:
+            from urllib.request import pathname2url
+        except ImportError:
+            from urllib import pathname2url
+
+        uri = 'file:%s?mode=ro&immutable=1' % pathname2url(os.path.abspath(self.m_sqlite_file))
+        engine = create_engine('sqlite://', creator=lambda: sqlite3.connect(uri, uri=True, check_same_thread=False),
+                               poolclass=NullPool)
+        factory = sessionmaker(bind=engine)
+        sessions = self.m_sessions = weakref.WeakSet()
+
+        def session():
+            # kept, to be closed whichever thread opened them
+            retval = factory()
+            sessions.add(retval)
+            return retval
+
+        self.m_registry = scoped_session(session)
+        self.m_outdated = missing_columns(self.m_registry())
+
+    def _disconnect(self):
+        """Closes the sessions opened by :py:meth:`Database._connect`"""
+
+        if self.__dict__.get('m_pid') != os.getpid():
+            # sessions inherited from another process are left alone
+            return
+        if self.__dict__.get('m_registry') is not None:
+            self.m_registry.remove()
+            for session in list(self.m_sessions):
+                session.close()
+        session = self.__dict__.get('_m_session')
+        if session is not None:
+            try:
+                session.close()
+                session.bind.dispose()
+            except (TypeError, AttributeError, KeyError):
+                # the interpreter may be exiting
+                pass
+        self.m_registry = None
+        self.m_session = None
+
+    @property
+    def m_objects(self):
+        """The :py:class:`.File` objects loaded by id (with the ``columnar``
+        backend)"""
+
+        return self._state().objects
+
+    @property
+    def m_cache(self):
+        """The :py:meth:`Database.objects` result cache"""
+
+        return self._state().cache
+
+    def _state(self):
+        """Returns the loaded objects and cached results. With
+        ``process_safe``, each thread has its own, as objects are bound to the
+        session of the thread which loaded them."""
+
+        if self.m_process_safe:
+            self._check_fork()
+            state = self.m_local
+        else:
+            state = self.m_shared
+        if getattr(state, 'generation', None) != self.m_generation:
+            # dropped since, see Database.clear_cache
+            state.objects = {}
+            state.cache = collections.OrderedDict()
+            state.generation = self.m_generation
+        return state
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # sessions, locks and the objects bound to sessions are not copied
+        for k in ('_m_session', 'm_registry', 'm_sessions', 'm_lock', 'm_shared', 'm_local'):
+            state.pop(k, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.m_lock = threading.RLock()
+        self.m_shared = types.SimpleNamespace()
+        self.m_local = threading.local()
+        self._connect()
+
+    def __del__(self):
+        self._disconnect()
+
+    def close_sessions(self, all_threads=True):
+        """Closes the sessions of the threads (``process_safe`` mode), which
+        should no longer be running queries. Sessions are opened again as
+        needed.
+
+        Keyword Parameters:
+
+        all_threads
+            If set (the default), closes the sessions of all threads and drops
+            the loaded objects. Otherwise, only closes the session of the
+            current thread.
+        """
+
+        if self.m_registry is None:
+            return
+        self.m_registry.remove()
+        if all_threads:
+            for session in list(self.m_sessions):
+                session.close()
+            self.m_generation += 1
+
+    def query(self, *args):
+        """Creates a query to the database using the given arguments"""
+
+        if self.m_backend == 'snapshot':
+            raise ValueError("The snapshot backend answers queries without SQL, use the 'sql' backend")
+        return super(Database, self).query(*args)
+
+    def is_valid(self):
+        """Returns if the database (or its snapshot) could be opened, and has
+        all the columns of the models"""
+
+        if getattr(self, 'm_backend', None) == 'snapshot':
+            return self.m_index is not None
+        return not self.m_outdated and super(Database, self).is_valid()
+
+    def assert_validity(self):
+        """Raises an :py:exc:`IOError` if the database (or its snapshot) could
+        not be opened, or if it was created by an older version of this package"""
+
+        if self.m_outdated:
+            raise IOError("The database '%s' was created by an older version of this package, it lacks the "
+                          "columns %s: create it again with `bob_dbmanage.py asvspoof2017 create --recreate', "
+                          "or migrate it with `bob_dbmanage.py asvspoof2017 create --update'" %
+                          (self.m_sqlite_file, ', '.join(self.m_outdated)))
+        if self.m_backend == 'snapshot' and self.m_index is None:
+            raise IOError("The database snapshot cannot be found at expected location '%s'." % self.m_snapshot)
+        super(Database, self).assert_validity()
+
+    def _mtime(self):
+        filename = self.m_sqlite_file
+        if self.m_backend == 'snapshot' and os.path.exists(self.m_snapshot):
+            filename = self.m_snapshot
+        try:
+            return os.path.getmtime(filename)
+        except OSError:
+            return None
+
+    def clear_cache(self):
+        """Empties the :py:meth:`Database.objects` result cache, of all
+        threads, drops the loaded objects and resets the cache statistics"""
+
+        self.m_generation += 1
+        self.m_cache_hits = 0
+        self.m_cache_misses = 0
+        self.m_vocabulary = {}
+
+    def cache_info(self):
+        """Returns a :py:class:`CacheInfo` with the hits, misses, maximum and
+        current size of the :py:meth:`Database.objects` result cache"""
+
+        return CacheInfo(self.m_cache_hits, self.m_cache_misses, self.m_cache_size, len(self.m_cache))
+
+    def _load_index(self):
+        """Loads the index of the ``columnar`` and ``snapshot`` backends"""
+
+        self.m_index = None
+        if self.m_backend == 'columnar' and self.is_valid():
+            self.m_index = ColumnarIndex.from_session(self.m_session)
+        elif self.m_backend == 'snapshot' and os.path.exists(self.m_snapshot):
+            self.m_index = ColumnarIndex.load(self.m_snapshot)
+        elif self.m_backend == 'snapshot' and os.path.exists(self.m_sqlite_file):
+            # the snapshot is written by 'create', but the downloaded database
+            # has none: it is read from the database file instead
+            from bob.db.base.utils import session_try_readonly
+            session = session_try_readonly('sqlite', self.m_sqlite_file)
+            try:
+                self.m_outdated = missing_columns(session)
+                if not self.m_outdated:
+                    self.m_index = ColumnarIndex.from_session(session)
+            finally:
+                session.close()
+                session.bind.dispose()
+
+    def _check_cache(self):
+        """Drops everything read from the database if its file (or snapshot)
+        changed since: the cache, the loaded objects and the index. The file is
+        then opened again, as it may have been replaced."""
+
+        mtime = self._mtime()
+        if mtime == self.m_cache_mtime:
+            return
+        with self.m_lock:
+            if mtime == self.m_cache_mtime:
+                return
+            self.clear_cache()
+            self._disconnect()
+            self._connect()
+            self._load_index()
+            self.m_cache_mtime = mtime
+
+    def _valid_protocols(self):
+        if self.m_index is not None:
+            return self.m_index.protocols
+        if 'protocols' not in self.m_vocabulary:
+            self.m_vocabulary['protocols'] = [k.name for k in self.protocols()]
+        return self.m_vocabulary['protocols']
+
+    def _valid_clients(self):
+        if self.m_index is not None:
+            return self.m_index.clients
+        if 'clients' not in self.m_vocabulary:
+            self.m_vocabulary['clients'] = [k.id for k in self.clients()]
+        return self.m_vocabulary['clients']
+
+    def _index_objects(self, rows):
+        """Returns the objects at the given positions of the index: records
+        with the ``snapshot`` backend, :py:class:`.File` objects otherwise"""
+
+        if self.m_backend == 'snapshot':
+            return self.m_index.records(rows)
+        return self._objects_by_id(self.m_index.ids[rows])
+
+    def _objects_by_id(self, ids, chunk=500):
+        """Returns the :py:class:`.File` objects for the given ids, in order.
+        Objects are loaded once, in chunks, and kept for later queries."""
+
+        loaded = self.m_objects
+        missing = [int(k) for k in ids if int(k) not in loaded]
+        for i in range(0, len(missing), chunk):
+            q = self.m_session.query(File).filter(File.id.in_(missing[i:i + chunk]))
+            loaded.update((k.id, k) for k in q)
+        return [loaded[int(k)] for k in ids]
 
     def objects(self, attacks=File.attack_choices,
                 protocol='competition', groups=Client.group_choices, purposes='genuine',
-                gender=Client.gender_choices, clients=None):
+                gender=Client.gender_choices, clients=None, min_duration=None, max_duration=None, order_by='path',
+                shard=None, num_shards=None, balance='count'):
         """Returns a list of unique :py:class:`.File` objects for the specific
         query by the user.
 
@@ -66,11 +543,278 @@ class Database(bob.db.base.SQLiteDatabase):
             client identifiers from which files should be retrieved. If ommited, set
             to None or an empty list, then data from all clients is retrieved.
 
+        min_duration, max_duration
+            If set, only returns the files lasting at least, or at most, that
+            many seconds. This requires the durations stored by ``create
+            --audiodir``: files of unknown duration are then left out.
+
+        order_by
+            ``'path'`` (the default) or ``'duration'``, to sort files from the
+            shortest to the longest, by stored duration. Files of unknown
+            duration come last, and files of equal duration are sorted by path.
+
+        shard, num_shards
+            If set, only returns the files of the given shard (from ``0`` to
+            ``num_shards - 1``) of the result. Shards are disjoint, cover the
+            whole result, and only depend on the query parameters, so that
+            each task of an array job can get its own.
+
+        balance
+            How shards are balanced: ``'count'`` (the default) splits the result
+            in contiguous runs of about the same number of files,
+            ``'duration'`` and ``'size'`` give all shards about the same total
+            audio duration or file size (see :py:func:`partition`). Durations
+            are the ones stored by ``create --audiodir``: each of many shard
+            tasks would otherwise read all audio headers. Sizes are those of
+            the files in the ``original_directory`` of this database.
+
         Returns: A list of :py:class:`.File` objects.
         """
 
+        self._check_cache()
+        self.assert_validity()
+
+        protocol, groups, purposes, attacks, gender, clients = self._normalize(
+            attacks, protocol, groups, purposes, gender, clients)
+
+        retval = self._cached(self._objects, protocol, groups, purposes, attacks, gender, clients)
+        retval = self._arrange(retval, min_duration, max_duration, order_by)
+        return self._shard(retval, shard, num_shards, balance)
+
+    def iter_objects(self, attacks=File.attack_choices,
+                     protocol='competition', groups=Client.group_choices, purposes='genuine',
+                     gender=Client.gender_choices, clients=None, chunk_size=1000, offset=0, limit=None):
+        """Yields the same :py:class:`.File` objects as :py:meth:`Database.objects`,
+        in the same order, fetching them in chunks.
+
+        The first objects are available as soon as the first chunk is read, and
+        only one chunk is held at a time. Chunks are read with keyset pagination
+        on :py:attr:`.File.path`: no query stays open between them, so that the
+        database may be used while iterating. Results are not cached.
+
+        Keyword parameters:
+
+        chunk_size
+            The number of objects read from the database at a time.
+
+        offset
+            The number of matching objects to skip.
+
+        limit
+            If set, the maximum number of objects to yield.
+
+        The other keyword parameters are the same as for
+        :py:meth:`Database.objects`.
+        """
+
+        self._check_cache()
+        self.assert_validity()
+
+        protocol, groups, purposes, attacks, gender, clients = self._normalize(
+            attacks, protocol, groups, purposes, gender, clients)
+        chunk_size = max(1, chunk_size)
+
+        if self.m_index is not None:
+            rows = self.m_index.select(protocol, groups=groups, purposes=purposes, attacks=attacks,
+                                       gender=gender, clients=clients)
+            rows = rows[offset:] if limit is None else rows[offset:offset + limit]
+            for start in range(0, len(rows), chunk_size):
+                for k in self._index_objects(rows[start:start + chunk_size]):
+                    yield k
+            return
+
+        q = self._query(protocol, groups, purposes, attacks, gender, clients)
+        last = None
+        while limit is None or limit > 0:
+            size = chunk_size if limit is None else min(chunk_size, limit)
+            if last is None:
+                chunk = q.offset(offset or None).limit(size).all()
+            else:
+                chunk = q.filter(File.path > last).limit(size).all()
+            for k in chunk:
+                yield k
+            if len(chunk) < size:
+                return
+            last = chunk[-1].path
+            if limit is not None:
+                limit -= len(chunk)
+
+    def records(self, attacks=File.attack_choices,
+                protocol='competition', groups=Client.group_choices, purposes='genuine',
+                gender=Client.gender_choices, clients=None, min_duration=None, max_duration=None, order_by='path',
+                shard=None, num_shards=None, balance='count'):
+        """Returns the same files as :py:meth:`Database.objects`, as lightweight
+        :py:class:`.FileRecord` tuples instead of database-bound objects.
+
+        Records hold the same columns as :py:class:`.File` and provide the same
+        path, loading and saving helpers, but are neither attached to a session
+        nor carry a ``client`` relationship. They are much cheaper to build and
+        to keep in memory. The keyword parameters are the same as for
+        :py:meth:`Database.objects`.
+
+        Returns: A list of :py:class:`.FileRecord` objects.
+        """
+
+        self._check_cache()
         self.assert_validity()
 
+        protocol, groups, purposes, attacks, gender, clients = self._normalize(
+            attacks, protocol, groups, purposes, gender, clients)
+
+        retval = self._cached(self._records, protocol, groups, purposes, attacks, gender, clients)
+        retval = self._arrange(retval, min_duration, max_duration, order_by)
+        return self._shard(retval, shard, num_shards, balance)
+
+    def _arrange(self, objects, min_duration, max_duration, order_by):
+        """Filters and sorts the objects by duration, see
+        :py:meth:`Database.objects`"""
+
+        if order_by not in self.order_choices:
+            raise ValueError("Unknown order `%s', choose one of %s" % (order_by, self.order_choices))
+        if min_duration is None and max_duration is None and order_by == 'path':
+            return objects
+
+        durations = self._stored('duration')
+        if min_duration is not None or max_duration is not None:
+            low = float('-inf') if min_duration is None else min_duration
+            high = float('inf') if max_duration is None else max_duration
+            objects = [k for k in objects if durations.get(k.id) is not None and low <= durations[k.id] <= high]
+        if order_by == 'duration':
+            # a stable sort: ties stay sorted by path
+            objects = sorted(objects, key=lambda k: (durations.get(k.id) is None, durations.get(k.id) or 0.))
+        return objects
+
+    def _stored(self, column):
+        """Returns a dictionary mapping the ids of the files of which the given
+        audio column, ``'duration'`` or ``'samples'``, is stored to its value"""
+
+        import numpy
+
+        self._check_cache()
+        if column not in self.m_vocabulary:
+            if self.m_index is not None:
+                values = self.m_index.durations if column == 'duration' else self.m_index.samples
+                known = numpy.flatnonzero(values >= 0)  # NaN or -1 if unknown
+                stored = zip(self.m_index.ids[known].tolist(), values[known].tolist())
+            else:
+                stored = self.m_session.query(File.id, getattr(File, column)).filter(getattr(File, column) != None)
+            self.m_vocabulary[column] = dict(stored)
+        return self.m_vocabulary[column]
+
+    def lengths(self, objects, directory=None):
+        """Returns the number of samples of the audio file of each object
+
+        Keyword parameters:
+
+        objects
+            The :py:class:`.File` objects (or records) to look up.
+
+        directory
+            The directory of the audio files, as for
+            :py:meth:`Database.load_audio`. Only the files whose length is not
+            stored in the database (see ``create --audiodir``) are read, and
+            their headers only once: their lengths are kept with the database.
+        """
+
+        from .audio import wav_info
+
+        if directory is None:
+            directory = self.original_directory
+        stored = self._stored('samples')
+        scanned = self.m_vocabulary.setdefault(('scanned', directory), {})
+        missing = [k for k in objects if k.id not in stored and k.id not in scanned]
+        paths = self.make_paths(missing, directory, self.original_extension or '.wav')
+        for k, path in zip(missing, paths):
+            scanned[k.id] = wav_info(path).nframes
+        return [stored[k.id] if k.id in stored else scanned[k.id] for k in objects]
+
+    def batches(self, max_samples, num_buckets=10, shuffle=False, seed=0, directory=None, **kwargs):
+        """Returns an iterator over minibatches of files of similar length
+
+        Keyword parameters:
+
+        max_samples
+            The budget of each batch, in samples: the number of files in a batch
+            times the length of its longest file (the size of the padded batch)
+            is at most this. Longer files make batches of their own.
+
+        num_buckets, shuffle, seed
+            See :py:func:`length_batches`. Use a different seed for each
+            training epoch.
+
+        directory
+            The directory of the audio files whose length is not stored, see
+            :py:meth:`Database.lengths`.
+
+        The other keyword parameters select the files, as for
+        :py:meth:`Database.objects`. Each batch is a list of objects.
+        """
+
+        objects = self.objects(**kwargs)
+        batches = length_batches(self.lengths(objects, directory), max_samples, num_buckets, shuffle, seed)
+        return ([objects[i] for i in batch] for batch in batches)
+
+    def _shard(self, objects, shard, num_shards, balance):
+        """Returns the given shard of the objects, see :py:meth:`Database.objects`"""
+
+        if shard is None and num_shards is None:
+            return objects
+        if shard is None or not num_shards or not 0 <= shard < num_shards:
+            raise ValueError("Shard %s is not one of the %s shards" % (shard, num_shards))
+        if balance not in self.balance_choices:
+            raise ValueError("Unknown balance `%s', choose one of %s" % (balance, self.balance_choices))
+
+        if balance == 'count':
+            shards = [i * num_shards // len(objects) for i in range(len(objects))]
+        else:
+            shards = partition(self._weights(objects, balance), num_shards).tolist()
+        return [k for k, i in zip(objects, shards) if i == shard]
+
+    def _weights(self, objects, balance):
+        """Returns the stored duration (in seconds) or the size (in bytes) of
+        the audio file of each object"""
+
+        if balance == 'size':
+            paths = self.make_paths(objects, self.original_directory, self.original_extension or '.wav')
+            return [os.path.getsize(k) for k in paths]
+
+        durations = self._stored('duration')
+        missing = sum(1 for k in objects if k.id not in durations)
+        if missing:
+            raise ValueError("The durations of %d files are not stored in the database: create it, or "
+                             "update it with --update, with --audiodir to balance shards by duration" % missing)
+        return [durations[k.id] for k in objects]
+
+    def _cached(self, query, protocol, groups, purposes, attacks, gender, clients):
+        """Returns ``query(protocol, groups, ...)`` through the result cache"""
+
+        if not self.m_cache_size:
+            return query(protocol, groups, purposes, attacks, gender, clients)
+
+        key = (query.__name__,) + tuple(tuple(sorted(k)) if k else None
+                                        for k in (protocol, groups, purposes, attacks, gender, clients))
+        with self.m_lock:
+            cache = self.m_cache
+            retval = cache.get(key)
+            if retval is not None:
+                self.m_cache_hits += 1
+                cache.move_to_end(key)
+            else:
+                self.m_cache_misses += 1
+        if retval is None:
+            retval = query(protocol, groups, purposes, attacks, gender, clients)
+            with self.m_lock:
+                cache[key] = retval
+                while len(cache) > self.m_cache_size:
+                    cache.popitem(last=False)
+
+        # a copy, so that callers may modify the returned list
+        return list(retval)
+
+    def _normalize(self, attacks, protocol, groups, purposes, gender, clients):
+        """Validates the parameters of :py:meth:`Database.objects`, returns them
+        as ``(protocol, groups, purposes, attacks, gender, clients)``"""
+
         # check if groups set are valid
         VALID_GROUPS = self.groups()
         groups = self.check_parameters_for_validity(
@@ -92,17 +836,49 @@ class Database(bob.db.base.SQLiteDatabase):
             purposes, "purpose", VALID_PURPOSE, None)
 
         # check protocol validity
-        VALID_PROTOCOLS = [k.name for k in self.protocols()]
+        VALID_PROTOCOLS = self._valid_protocols()
         protocol = self.check_parameters_for_validity(
             protocol, "protocol", VALID_PROTOCOLS, ('competition',))
 
         # checks client identity validity
-        VALID_CLIENTS = [k.id for k in self.clients()]
+        VALID_CLIENTS = self._valid_clients()
         clients = self.check_parameters_for_validity(
             clients, "client", VALID_CLIENTS, None)
 
+        return protocol, groups, purposes, attacks, gender, clients
+
+    def _objects(self, protocol, groups, purposes, attacks, gender, clients):
+        """Runs the query of :py:meth:`Database.objects` for already validated
+        parameters"""
+
+        if self.m_index is not None:
+            rows = self.m_index.select(protocol, groups=groups, purposes=purposes, attacks=attacks,
+                                       gender=gender, clients=clients)
+            return self._index_objects(rows)
+
         # now query the database
         retval = []
+        retval += list(self._query(protocol, groups, purposes, attacks, gender, clients))
+
+        return retval
+
+    def _records(self, protocol, groups, purposes, attacks, gender, clients):
+        """Runs the query of :py:meth:`Database.records` for already validated
+        parameters"""
+
+        if self.m_index is not None:
+            rows = self.m_index.select(protocol, groups=groups, purposes=purposes, attacks=attacks,
+                                       gender=gender, clients=clients)
+            return self.m_index.records(rows)
+
+        q = self._query(protocol, groups, purposes, attacks, gender, clients)
+        q = q.with_entities(*[getattr(File, k) for k in FileRecord._fields])
+        # plain columns: bypasses the per-value processing of the ORM
+        return [FileRecord(*k) for k in self._execute(q)]
+
+    def _query(self, protocol, groups, purposes, attacks, gender, clients):
+        """Builds the SQL query of :py:meth:`Database.objects` for already
+        validated parameters"""
 
         q = self.m_session.query(File).join(ProtocolFiles).join(
             (Protocol, ProtocolFiles.protocol)).join(Client)
@@ -118,9 +894,37 @@ class Database(bob.db.base.SQLiteDatabase):
             q = q.filter(File.purpose.in_(purposes))
         q = q.filter(Protocol.name.in_(protocol))
         q = q.order_by(File.path)
-        retval += list(q)
 
-        return retval
+        return q
+
+    def explain(self, attacks=File.attack_choices,
+                protocol='competition', groups=Client.group_choices, purposes='genuine',
+                gender=Client.gender_choices, clients=None):
+        """Returns the SQLite query plan of :py:meth:`Database.objects` for the
+        given parameters, which have the same meaning as there.
+
+        Returns: A list of strings, one per step of the plan, as given by
+        ``EXPLAIN QUERY PLAN``. Steps starting with ``SCAN`` read a whole table.
+        """
+
+        self.assert_validity()
+        if self.m_backend == 'snapshot':
+            raise ValueError("The snapshot backend does not run SQL queries")
+
+        q = self._query(*self._normalize(attacks, protocol, groups, purposes, gender, clients))
+        return [str(row[-1]) for row in self._execute(q, 'EXPLAIN QUERY PLAN ')]
+
+    def _execute(self, q, prefix=''):
+        """Runs the given query directly on the DB-API connection, with its
+        bound parameters, returns the cursor with the raw result rows"""
+
+        # the IN lists are rendered as one parameter per value
+        compiled = q.statement.compile(dialect=self.m_session.bind.dialect,
+                                       compile_kwargs={'render_postcompile': True})
+        params = compiled.construct_params()
+        cursor = self.m_session.connection().connection.cursor()
+        cursor.execute(prefix + compiled.string, [params[k] for k in compiled.positiontup])
+        return cursor
 
     def files(self, directory=None, extension=None, **object_query):
         """Returns a set of filenames for the specific query by the user.
@@ -181,6 +985,10 @@ class Database(bob.db.base.SQLiteDatabase):
         gender = self.check_parameters_for_validity(
             gender, "gender", self.genders(), None)
 
+        if self.m_backend == 'snapshot':
+            self.assert_validity()
+            return self.m_index.client_records(groups, gender)
+
         retval = []
         if groups:
             q = self.m_session.query(Client).filter(Client.group.in_(groups))
@@ -195,12 +1003,20 @@ class Database(bob.db.base.SQLiteDatabase):
         """Returns True if we have a client with a certain integer identifier"""
 
         self.assert_validity()
+        if self.m_backend == 'snapshot':
+            return id in self.m_index.clients
         return self.m_session.query(Client).filter(Client.id == id).count() != 0
 
     def client(self, id):
         """Returns the Client object in the database given a certain id. Raises
         an error if that does not exist."""
 
+        if self.m_backend == 'snapshot':
+            self.assert_validity()
+            found = [k for k in self.m_index.client_records() if k.id == id]
+            if not found:
+                raise KeyError("There is no client `%s' in the database" % (id,))
+            return found[0]
         return self.m_session.query(Client).filter(Client.id == id).one()
 
     def protocols(self):
@@ -208,6 +1024,8 @@ class Database(bob.db.base.SQLiteDatabase):
         """
 
         self.assert_validity()
+        if self.m_backend == 'snapshot':
+            return self.m_index.protocol_records()
         return list(self.m_session.query(Protocol))
 
     def protocol_names(self):
@@ -221,6 +1039,8 @@ class Database(bob.db.base.SQLiteDatabase):
         """Tells if a certain protocol is available"""
 
         self.assert_validity()
+        if self.m_backend == 'snapshot':
+            return name in self.m_index.protocols
         return self.m_session.query(Protocol).filter(Protocol.name == name).count() != 0
 
     def protocol(self, name):
@@ -228,6 +1048,11 @@ class Database(bob.db.base.SQLiteDatabase):
         an error if that does not exist."""
 
         self.assert_validity()
+        if self.m_backend == 'snapshot':
+            found = [k for k in self.m_index.protocol_records() if k.name == name]
+            if not found:
+                raise KeyError("There is no protocol `%s' in the database" % (name,))
+            return found[0]
         return self.m_session.query(Protocol).filter(Protocol.name == name).one()
 
     def groups(self):
@@ -250,6 +1075,30 @@ class Database(bob.db.base.SQLiteDatabase):
 
         return File.attack_choices
 
+    def reverse(self, paths, preserve_order=True):
+        """Returns the files with the given path stems
+
+        Keyword Parameters:
+
+        paths
+            The path stems to look up.
+
+        preserve_order
+            If set (the default), returns one file per path, in the same order,
+            and raises a :py:exc:`KeyError` for unknown paths. Otherwise,
+            returns the files of the known paths only, in any order.
+        """
+
+        if self.m_backend != 'snapshot':
+            return super(Database, self).reverse(paths, preserve_order)
+
+        self.assert_validity()
+        paths = list(paths)
+        rows = self.m_index.lookup(paths)
+        if preserve_order and (rows < 0).any():
+            raise KeyError(paths[int((rows < 0).argmax())])
+        return self.m_index.records(rows[rows >= 0])
+
     def paths(self, ids, prefix='', suffix=''):
         """Returns a full file paths considering particular file ids, a given
         directory and an extension
@@ -273,9 +1122,186 @@ class Database(bob.db.base.SQLiteDatabase):
 
         self.assert_validity()
 
-        fobj = self.m_session.query(File).filter(File.id.in_(ids))
-        retval = []
-        for p in ids:
-            retval.extend([k.make_path(prefix, suffix)
-                           for k in fobj if k.id == p])
-        return retval
+        # NumPy ids, as given by the columnar index or the sampler, are not
+        # equal to the keys of the mapping
+        ids = [int(k) for k in ids]
+        path = self._path_map(ids)
+        return join_paths([path[k] for k in ids if k in path], prefix, suffix)
+
+    def make_paths(self, objects_or_ids, directory=None, extension=None):
+        """Returns the full paths of many files at once, in a single pass
+
+        Keyword Parameters:
+
+        objects_or_ids
+            An iterable of :py:class:`.File` objects (or any object with a
+            ``path`` attribute) or of file ids. Both may be mixed.
+
+        directory
+            An optional directory name that will be prefixed to every path.
+
+        extension
+            An optional extension that will be suffixed to every path.
+
+        Returns a list with one path per input, in the same order, equal to what
+        :py:meth:`.File.make_path` would return. Raises a :py:exc:`KeyError` if
+        any of the given ids does not exist in the database.
+        """
+
+        stems = [getattr(k, 'path', k) for k in objects_or_ids]
+        stems = [k if isinstance(k, str) else int(k) for k in stems]
+        ids = [k for k in stems if not isinstance(k, str)]
+        if ids:
+            path = self._path_map(ids)
+            missing = [k for k in ids if k not in path]
+            if missing:
+                raise KeyError("File ids %s do not exist in the database" % (missing[:10],))
+            stems = [k if isinstance(k, str) else path[k] for k in stems]
+        return join_paths(stems, directory, extension)
+
+    def load_audio(self, objects, directory=None, num_workers=8, dtype=None, concatenate=False):
+        """Loads the audio samples of many files, reading them concurrently
+
+        Keyword Parameters:
+
+        objects
+            An iterable of :py:class:`.File` objects, records or file ids.
+
+        directory
+            The directory containing the audio files. Defaults to the
+            ``original_directory`` of this database.
+
+        num_workers
+            The number of threads reading files in parallel. File reads release
+            the GIL, so that they overlap.
+
+        dtype
+            The NumPy type of the returned samples (see
+            :py:func:`.audio.read_wav`). Defaults to the type in the files.
+
+        concatenate
+            If set, returns all samples in a single array instead of a list.
+
+        Returns a list with one array of shape ``(channels, samples)`` per file
+        or, if ``concatenate`` is set, a tuple ``(data, offsets)``: ``data`` has
+        the samples of all files one after the other, those of file ``i`` being
+        ``data[:, offsets[i]:offsets[i + 1]]``.
+        """
+
+        import numpy
+        from concurrent.futures import ThreadPoolExecutor
+        from .audio import read_wav
+
+        if directory is None:
+            directory = self.original_directory
+        paths = self.make_paths(objects, directory, self.original_extension or '.wav')
+
+        with ThreadPoolExecutor(max_workers=max(1, num_workers)) as pool:
+            data = list(pool.map(lambda path: read_wav(path, dtype), paths))
+
+        if not concatenate:
+            return data
+
+        offsets = numpy.cumsum([0] + [k.shape[1] for k in data])
+        if not data:
+            return numpy.empty((1, 0), dtype=dtype or 'int16'), offsets
+        return numpy.concatenate(data, axis=1), offsets
+
+    def save_many(self, objects, arrays, directory, extension='.hdf5', num_workers=8,
+                  skip_existing=False, processes=False):
+        """Saves one array per file, writing many files concurrently
+
+        Keyword Parameters:
+
+        objects
+            An iterable of :py:class:`.File` objects, records or file ids.
+
+        arrays
+            The arrays to save, in the same order as ``objects``, or a function
+            returning the array to save for a given object. A function is only
+            called for the files that are actually written.
+
+        directory
+            The directory in which to save the files. Each distinct output
+            directory is created once.
+
+        extension
+            The extension of the files, which selects the output format (see
+            :py:meth:`.File.save`).
+
+        num_workers
+            The number of files written in parallel.
+
+        skip_existing
+            If set, files that already exist are not written again, so that an
+            interrupted run can be resumed. The existing files are found by
+            listing each output directory once.
+
+        processes
+            If set, files are written by a pool of processes instead of threads.
+            The arrays are then computed in this process and sent to the
+            workers.
+
+        Returns the list of the paths that were written.
+        """
+
+        import bob.io.base
+        from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+        from .checkfiles import list_directory
+
+        objects = list(objects)
+        paths = self.make_paths(objects, directory, extension)
+        if not callable(arrays):
+            arrays = list(arrays)
+            if len(arrays) != len(objects):
+                raise ValueError("Got %d arrays for %d files" % (len(arrays), len(objects)))
+
+        listings = {}
+        for path in paths:
+            parent = os.path.dirname(path)
+            if parent not in listings:
+                listings[parent] = list_directory(parent) if skip_existing else set()
+                bob.io.base.create_directories_safe(parent)
+
+        def exists(path):
+            names = listings[os.path.dirname(path)]
+            if names is None:  # the directory cannot be listed
+                return os.path.exists(path)
+            return os.path.basename(path) in names
+
+        todo = [i for i, path in enumerate(paths) if not (skip_existing and exists(path))]
+
+        def data(i):
+            return arrays(objects[i]) if callable(arrays) else arrays[i]
+
+        num_workers = max(1, num_workers)
+        if not processes:
+            with ThreadPoolExecutor(max_workers=num_workers) as pool:
+                return list(pool.map(lambda i: _save_array(data(i), paths[i]), todo))
+
+        written = []
+        with ProcessPoolExecutor(max_workers=num_workers) as pool:
+            # only a few arrays are held in memory at a time
+            chunk = 4 * num_workers
+            for start in range(0, len(todo), chunk):
+                rows = todo[start:start + chunk]
+                written += pool.map(_save_array, [data(i) for i in rows], [paths[i] for i in rows])
+        return written
+
+    def _path_map(self, ids, chunk=500):
+        """Returns a dictionary mapping the existing ones of the given ids to
+        their path stems"""
+
+        if self.m_index is not None:
+            if 'paths' not in self.m_vocabulary:
+                self.m_vocabulary['paths'] = dict(zip(self.m_index.ids.tolist(), self.m_index.paths.tolist()))
+            return self.m_vocabulary['paths']
+
+        if 'paths' in self.m_vocabulary or len(ids) > chunk:
+            # for many ids, a single scan is cheaper than many lookups
+            self._check_cache()
+            if 'paths' not in self.m_vocabulary:
+                self.m_vocabulary['paths'] = dict(self.m_session.query(File.id, File.path))
+            return self.m_vocabulary['paths']
+
+        return dict(self.m_session.query(File.id, File.path).filter(File.id.in_(ids)))
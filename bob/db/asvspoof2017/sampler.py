@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""Class-balanced random sampling of the files of the database.
+
+Besides the purpose (genuine or spoof), the files of the dev set, or of the
+train and dev sets together, are unevenly spread over environments and
+playback and recording devices. :py:class:`BalancedSampler` groups the files in
+strata by these attributes once, as NumPy index arrays, and then draws
+minibatches balanced in levels: evenly over the values of the first attribute
+(the purpose, by default), and then, within each of them, evenly over the
+strata that exist for it. Each draw costs a time independent of the number of
+files.
+"""
+
+import numpy
+
+
+class BalancedSampler(object):
+    """Draws minibatches of files balanced over strata
+
+    Keyword parameters:
+
+    database
+        An open :py:class:`.Database`.
+
+    strata
+        The :py:class:`.FileRecord` attributes defining the strata: files with
+        the same values of all of them make a stratum. Batches are split
+        evenly over the values of the first attribute, and then over the
+        strata sharing each value: with the default, half of the files are
+        genuine and half are spoofs, whatever the number of attack conditions.
+
+    seed
+        The seed of the random draws: the same seed gives the same batches.
+
+    kwargs
+        Select the files, as for :py:meth:`.Database.records`. Genuine and
+        spoof files are selected unless ``purposes`` is given.
+
+    Batches are drawn with ``sampler.draw(batch_size)``, or iterated with
+    ``sampler.batches(batch_size, num_batches)``::
+
+        sampler = BalancedSampler(Database(), groups=('train', 'dev'), seed=epoch)
+        for ids in sampler.batches(64, 100):
+            ...
+
+    Files are drawn with replacement, so that small strata are as likely to be
+    drawn as large ones.
+    """
+
+    def __init__(self, database, strata=('purpose', 'environment', 'playback_device', 'recording_device'), seed=0,
+                 **kwargs):
+        from .models import File
+
+        kwargs.setdefault('purposes', File.purpose_choices)
+        records = database.records(**kwargs)
+        if not records:
+            raise ValueError("No file matches the selection %s" % (kwargs,))
+
+        self.strata = tuple(strata)
+        self.ids = numpy.array([k.id for k in records], dtype=numpy.int64)
+        self.paths = numpy.array([k.path for k in records], dtype=numpy.str_)
+
+        # the attribute values of each stratum
+        keys = [tuple(getattr(k, name) for name in self.strata) for k in records]
+        self.keys = sorted(set(keys))
+        code = dict((k, i) for i, k in enumerate(self.keys))
+        codes = numpy.array([code[k] for k in keys], dtype=numpy.int64)
+
+        # the positions of the files of each stratum, one stratum after the other
+        self.m_order = numpy.argsort(codes, kind='mergesort')
+        self.counts = numpy.bincount(codes, minlength=len(self.keys))
+        self.m_starts = numpy.concatenate(([0], numpy.cumsum(self.counts)[:-1]))
+
+        # the strata sharing each value of the first attribute, which are
+        # contiguous as the keys are sorted
+        first = [k[0] for k in self.keys]
+        bounds = [i for i in range(1, len(first)) if first[i] != first[i - 1]]
+        self.m_levels = numpy.split(numpy.arange(len(self.keys)), bounds)
+
+        self.rng = numpy.random.RandomState(seed)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def stratum(self, key):
+        """Returns the positions of the files of the stratum with the given
+        attribute values"""
+
+        i = self.keys.index(tuple(key))
+        return self.m_order[self.m_starts[i]:self.m_starts[i] + self.counts[i]]
+
+    def draw(self, batch_size, paths=False):
+        """Draws a minibatch
+
+        Keyword parameters:
+
+        batch_size
+            The number of files of the batch. Each value of the first
+            attribute gets ``batch_size // len(values)`` of them, shared in the
+            same way by the strata with that value, and the remaining ones go
+            to randomly chosen values and strata.
+
+        paths
+            If set, returns the paths of the files instead of their ids.
+
+        Returns a NumPy array with the ids (or paths) of the files, sorted by
+        stratum, which may be given as they are to
+        :py:meth:`.Database.make_paths` or :py:meth:`.Database.load_audio`.
+        """
+
+        shares = numpy.bincount(self._split(batch_size, len(self.m_levels)), minlength=len(self.m_levels))
+        strata = numpy.concatenate([level[self._split(n, len(level))]
+                                    for level, n in zip(self.m_levels, shares)])
+        strata.sort()
+        offsets = (self.rng.random_sample(batch_size) * self.counts[strata]).astype(numpy.int64)
+        rows = self.m_order[self.m_starts[strata] + offsets]
+        return self.paths[rows] if paths else self.ids[rows]
+
+    def _split(self, n, k):
+        """Returns ``n`` positions among ``k``, each one ``n // k`` times and
+        the remaining ones at random"""
+
+        return numpy.concatenate((numpy.arange(n - n % k) % k, self.rng.permutation(k)[:n % k]))
+
+    def batches(self, batch_size, num_batches, paths=False):
+        """Yields ``num_batches`` minibatches, see
+        :py:meth:`BalancedSampler.draw`"""
+
+        for _ in range(num_batches):
+            yield self.draw(batch_size, paths)
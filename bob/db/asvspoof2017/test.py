@@ -31,6 +31,40 @@ def db_available(test):
     return wrapper
 
 
+def snapshot_available(test):
+    """Decorator skipping the tests which read the database snapshot, written by
+    'create' but not part of the downloaded database"""
+    from bob.io.base.test_utils import datafile
+    from nose.plugins.skip import SkipTest
+    import functools
+
+    @functools.wraps(test)
+    def wrapper(*args, **kwargs):
+        snapshot = datafile("db.npz", __name__, None)
+        if os.path.exists(snapshot):
+            return test(*args, **kwargs)
+        else:
+            raise SkipTest("The database snapshot '%s' is not available; run 'bob_dbmanage.py %s create' to write "
+                           "it" % (snapshot, 'asvspoof2017'))
+
+    return wrapper
+
+
+def write_wav(path, samples, rate=16000):
+    """Writes 16 bit mono samples to a WAV file, creating its directory"""
+    import numpy
+    import wave
+
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    w = wave.open(path, 'wb')
+    w.setnchannels(1)
+    w.setsampwidth(2)
+    w.setframerate(rate)
+    w.writeframes(numpy.asarray(samples, dtype='<i2').tobytes())
+    w.close()
+
+
 class ASVspoof2017DatabaseTest(unittest.TestCase):
     """Performs various tests on the AVspoof attack database."""
 
@@ -141,3 +175,1116 @@ class ASVspoof2017DatabaseTest(unittest.TestCase):
     def test20_queryS1AttacksCM(self):
         self.queryAttackType('competition', 'undefined', 0)
 
+
+    def test21_create(self):
+
+        import argparse
+        import shutil
+        import tempfile
+        from pkg_resources import resource_filename
+        from .create import create
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            dbfile = os.path.join(tmpdir, 'db.sql3')
+            args = argparse.Namespace(files=[dbfile], type='sqlite', recreate=False, update=False, verbose=0,
+                                      samplesdir='', protodir=resource_filename(__name__, 'protocols'),
+                                      audiodir=None, workers=8)
+            self.assertEqual(create(args), 0)
+
+            from bob.db.base.utils import session_try_readonly
+            s = session_try_readonly('sqlite', dbfile)
+            self.assertEqual(s.query(File).count(), 18946)
+            self.assertEqual(s.query(Client).count(), 19)
+            self.assertEqual(s.query(ProtocolFiles).count(), 18946)
+            self.assertEqual(s.query(File).filter(File.path == 'train/T_1000001').one().client_id, 'M0002')
+            s.close()
+
+            # an existing database is neither extended nor replaced by default
+            self.assertEqual(create(args), 2)
+            s = session_try_readonly('sqlite', dbfile)
+            self.assertEqual(s.query(File).count(), 18946)
+            s.close()
+
+            from .index import ColumnarIndex
+            snapshot = ColumnarIndex.load(os.path.join(tmpdir, 'db.npz'))
+            self.assertEqual(len(snapshot), 18946)
+            self.assertEqual(snapshot.protocols, ('competition',))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    @db_available
+    def test22_columnar_backend(self):
+
+        sql = Database()
+        columnar = Database(backend='columnar')
+        for query in (dict(), dict(purposes='spoof', groups='dev'), dict(purposes=None, clients='M0008'),
+                      dict(purposes=None, groups=('train', 'eval'), attacks='spoof')):
+            self.assertEqual([k.id for k in sql.objects(**query)], [k.id for k in columnar.objects(**query)])
+        self.assertRaises(ValueError, Database, backend='nosql')
+
+    @db_available
+    def test23_objects_cache(self):
+
+        db = Database(cache_size=2)
+        dev = db.objects(groups='dev', purposes=('spoof', 'genuine'))
+        dev.pop()  # returned lists are copies
+        self.assertEqual(len(db.objects(groups=('dev',), purposes=('genuine', 'spoof'))), len(dev) + 1)
+        self.assertEqual(db.cache_info().hits, 1)
+        self.assertEqual(db.cache_info().misses, 1)
+        db.objects(groups='train')
+        db.objects(groups='eval')
+        self.assertEqual(db.cache_info().currsize, 2)
+        db.clear_cache()
+        self.assertEqual(db.cache_info(), (0, 0, 2, 0))
+
+    @db_available
+    def test24_paths(self):
+
+        db = Database()
+        objects = db.objects(purposes=None, groups=None)
+        ids = [k.id for k in objects]
+        expected = [k.make_path('/data', '.wav') for k in objects]
+        self.assertEqual(db.paths(ids, '/data', '.wav'), expected)
+        self.assertEqual(db.make_paths(ids, '/data', '.wav'), expected)
+        self.assertEqual(db.make_paths(objects, '/data', '.wav'), expected)
+        self.assertEqual(db.paths([ids[0], -1]), [objects[0].path])
+        self.assertRaises(KeyError, db.make_paths, [ids[0], -1])
+
+        # NumPy ids, as the columnar index and the sampler give them
+        import numpy
+        db = Database()
+        self.assertEqual(db.paths(numpy.array(ids[:3]), '/data', '.wav'), expected[:3])
+        self.assertEqual(db.make_paths(numpy.array(ids[:3]), '/data', '.wav'), expected[:3])
+        self.assertEqual(db.make_paths(numpy.array(ids), '/data', '.wav'), expected)
+
+    @db_available
+    def test25_explain(self):
+
+        db = Database()
+        plan = db.explain(purposes='spoof', groups='dev')
+        self.assertTrue(plan)
+        self.assertTrue(any('file' in step for step in plan))
+        # the filtered queries read no whole table
+        for query in (dict(purposes='spoof', groups='dev'), dict(clients='M0001'),
+                      dict(purposes=('genuine', 'spoof'), groups='train'), dict(attacks='spoof', groups='eval')):
+            steps = db.explain(**query)
+            self.assertFalse([k for k in steps if k.startswith('SCAN')], (query, steps))
+        self.assertRaises(ValueError, db.explain, groups='world')
+
+    @db_available
+    def test26_records(self):
+
+        fields = FileRecord._fields
+        for db in (Database(), Database(backend='columnar')):
+            objects = db.objects(purposes=None, groups='dev')
+            records = db.records(purposes=None, groups='dev')
+            self.assertEqual([tuple(getattr(k, f) for f in fields) for k in objects], [tuple(k) for k in records])
+            self.assertEqual(records[0].audiofile('/data'), objects[0].audiofile('/data'))
+            self.assertEqual(records[0].is_real(), objects[0].is_real())
+
+        # values are bound as parameters, not written into the SQL text
+        db = Database()
+        q = db.m_session.query(File.id).filter(File.path.in_(["x' OR '1'='1", 'train/T_1000001']))
+        self.assertEqual([k[0] for k in db._execute(q)], [db.reverse(['train/T_1000001'])[0].id])
+
+    def test27_lazy_import(self):
+
+        # import-time benchmark: importing the package must not load SQLAlchemy
+        import subprocess
+        import sys
+        code = "import sys, bob.db.asvspoof2017; print(' '.join(sorted(sys.modules)))"
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        modules = result.stdout.split()
+        for name in ('sqlalchemy', 'pkg_resources', 'bob.db.base', 'bob.db.asvspoof2017.query'):
+            self.assertNotIn(name, modules)
+
+        # the cumulative import time, in microseconds, is reported by -X importtime
+        timing = [k for k in result.stderr.splitlines() if k.endswith('| bob.db.asvspoof2017')]
+        self.assertEqual(len(timing), 1)
+        self.assertGreater(int(timing[0].split('|')[1]), 0)
+
+    @db_available
+    def test28_manage_dumplist_invalid_client(self):
+
+        from bob.db.base.script.dbmanage import main
+
+        # clients are only validated once the command runs
+        self.assertEqual(main('asvspoof2017 dumplist --client=M0100 --self-test'.split()), 2)
+
+    def test29_find_missing(self):
+
+        import shutil
+        import tempfile
+        from .checkfiles import find_missing
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            os.makedirs(os.path.join(tmpdir, 'train'))
+            for name in ('T_1000001.wav', 'T_1000002.wav'):
+                open(os.path.join(tmpdir, 'train', name), 'w').close()
+            paths = [os.path.join(tmpdir, k) for k in
+                     ('train/T_1000001.wav', 'train/T_1000003.wav', 'dev/D_1000001.wav', 'train/T_1000002.wav')]
+            seen = []
+            for method in ('listdir', 'stat'):
+                missing = find_missing(paths, method=method, num_workers=2, progress=lambda d, t: seen.append((d, t)))
+                self.assertEqual(missing, [paths[1], paths[2]])
+                self.assertEqual(seen[-1], (4, 4))
+            self.assertRaises(ValueError, find_missing, paths, method='glob')
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test30_verify(self):
+
+        import shutil
+        import tempfile
+        import wave
+        from .checkfiles import verify
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            paths = [os.path.join(tmpdir, k) for k in ('ok.wav', 'short.wav', 'bad.wav', 'none.wav', 'dir.wav')]
+            for path in paths[:2]:
+                w = wave.open(path, 'wb')
+                w.setnchannels(1)
+                w.setsampwidth(2)
+                w.setframerate(16000)
+                w.writeframes(b'\x01\x00' * 1600)
+                w.close()
+            with open(paths[1], 'r+b') as f:
+                f.truncate(1000)
+            with open(paths[2], 'wb') as f:
+                f.write(b'not a wav file')
+            os.mkdir(paths[4])  # exists, but cannot be read
+
+            manifest = {}
+            results, mismatched = verify(paths, manifest=manifest, num_workers=2)
+            self.assertEqual([results[k] for k in paths], ['ok', 'truncated', 'corrupt', 'missing', 'unreadable'])
+            self.assertEqual(mismatched, [])
+            self.assertEqual(sorted(manifest), sorted(paths[:3]))
+
+            # same size and time: only a full re-hash notices the change
+            stat = os.stat(paths[0])
+            with open(paths[0], 'r+b') as f:
+                f.seek(100)
+                f.write(b'\x02')
+            os.utime(paths[0], (stat.st_atime, stat.st_mtime))
+            self.assertEqual(verify(paths, manifest=manifest)[1], [])
+            self.assertEqual(verify(paths, manifest=manifest, rehash=True)[1], [paths[0]])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    @db_available
+    def test31_load_audio(self):
+
+        import numpy
+        import shutil
+        import tempfile
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            db = Database(original_directory=tmpdir)
+            files = db.objects(clients='M0001')[:3]
+            for i, f in enumerate(files):
+                write_wav(f.audiofile(tmpdir), numpy.arange(100 * (i + 1)))
+
+            data = db.load_audio(files, num_workers=2)
+            self.assertEqual([k.shape for k in data], [(1, 100), (1, 200), (1, 300)])
+            self.assertEqual(data[1].dtype, numpy.int16)
+            self.assertTrue((data[2][0] == numpy.arange(300)).all())
+
+            buffer, offsets = db.load_audio([k.id for k in files], dtype='float64', concatenate=True)
+            self.assertEqual(buffer.shape, (1, 600))
+            self.assertEqual(list(offsets), [0, 100, 300, 600])
+            self.assertTrue((buffer[:, offsets[1]:offsets[2]] == data[1]).all())
+            ids = numpy.array([k.id for k in files], dtype=numpy.int64)
+            self.assertEqual([k.shape for k in db.load_audio(ids)], [(1, 100), (1, 200), (1, 300)])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    @db_available
+    def test32_audio_memmap(self):
+
+        import numpy
+        import shutil
+        import tempfile
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            db = Database()
+            f = db.objects(clients='M0001')[0]
+            write_wav(f.audiofile(tmpdir), numpy.arange(-500, 500), rate=8000)
+
+            data = f.audio_memmap(tmpdir)
+            self.assertIsInstance(data, numpy.memmap)
+            self.assertEqual(data.shape, (1, 1000))
+            self.assertEqual((data.rate, data.channels), (8000, 1))
+            self.assertEqual(list(data[0, 10:13]), [-490, -489, -488])
+            self.assertFalse(data.flags.writeable)
+            self.assertTrue((db.records(clients='M0001')[0].audio_memmap(tmpdir) == data).all())
+            del data
+        finally:
+            shutil.rmtree(tmpdir)
+
+    @db_available
+    def test33_pack(self):
+
+        import numpy
+        import shutil
+        import tempfile
+        from .pack import pack_audio, PackedAudio
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            db = Database()
+            files = db.objects(clients='M0001')[:3]
+            for i, f in enumerate(files):
+                write_wav(f.audiofile(tmpdir), numpy.arange(i, 101 * i + 1))
+            archive = os.path.join(tmpdir, 'audio.pack')
+            pack_audio([k.id for k in files], [k.audiofile(tmpdir) for k in files], archive, num_workers=2)
+
+            packed = PackedAudio(archive)
+            self.assertEqual(len(packed), 3)
+            self.assertEqual(packed.ids(), [k.id for k in files])
+            for f in files:
+                self.assertTrue(f.id in packed)
+                self.assertEqual(packed.rate(f.id), 16000)
+                self.assertTrue((packed[f.id] == numpy.asarray(f.audio_memmap(tmpdir))).all())
+            self.assertEqual(packed[files[0].id].shape, (1, 1))
+            self.assertFalse(-1 in packed)
+            del packed
+
+            # an index left from another archive
+            index = os.path.join(tmpdir, 'audio.pack.index.npz')
+            os.rename(index, index + '.old')
+            pack_audio([k.id for k in files], [k.audiofile(tmpdir) for k in files], archive, num_workers=2)
+            os.replace(index + '.old', index)
+            self.assertRaises(IOError, PackedAudio, archive)
+            pack_audio([], [], archive)
+            self.assertEqual(len(PackedAudio(archive)), 0)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test34_feature_store(self):
+
+        import numpy
+        import shutil
+        import tempfile
+        from concurrent.futures import ThreadPoolExecutor
+        from .featurestore import FeatureStore
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            def write(ids):
+                # each writer has its own store object, as separate processes would
+                store = FeatureStore(tmpdir, num_shards=3)
+                for k in ids:
+                    store.save(k, numpy.full((k % 5, 2), k, dtype=numpy.float64))
+
+            with ThreadPoolExecutor(4) as pool:
+                list(pool.map(write, [range(i, 40, 4) for i in range(4)]))
+
+            store = FeatureStore(tmpdir, num_shards=7)
+            self.assertEqual(store.num_shards, 3)
+            self.assertEqual(store.ids(), list(range(40)))
+            for k in range(40):
+                data = store.load(k)
+                self.assertEqual(data.shape, (k % 5, 2))
+                self.assertTrue((data == k).all())
+                self.assertFalse(data.flags.writeable)
+
+            # saving again replaces the array, also for an open store
+            store.save(3, numpy.arange(6, dtype=numpy.int16).reshape(2, 3))
+            FeatureStore(tmpdir).save(4, numpy.zeros(()))
+            self.assertEqual(store.load(3).tolist(), [[0, 1, 2], [3, 4, 5]])
+            self.assertEqual(FeatureStore(tmpdir).load(4).shape, ())
+            self.assertFalse(40 in store)
+            self.assertRaises(KeyError, store.load, 40)
+
+            f = FileRecord(41, 'train/T_1000041', 'genuine', None, None, None, None, None, 'M0001', 'train')
+            f.save(numpy.ones(4), store=store)
+            self.assertEqual(f.load(store=store).tolist(), [1.0] * 4)
+            del data, store
+
+            # a shard holding only empty arrays
+            store = FeatureStore(os.path.join(tmpdir, 'empty'), num_shards=2)
+            store.save(0, numpy.zeros((0, 3), dtype=numpy.float32))
+            self.assertEqual(os.path.getsize(os.path.join(tmpdir, 'empty', 'shard-000.bin')), 0)
+            self.assertEqual(FeatureStore(os.path.join(tmpdir, 'empty')).load(0).shape, (0, 3))
+            self.assertEqual(store.load(0).dtype, numpy.float32)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    @db_available
+    def test35_save_many(self):
+
+        import numpy
+        import shutil
+        import tempfile
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            db = Database()
+            files = db.objects(groups='train')[:4] + db.objects(groups='dev')[:2]
+            written = db.save_many(files, [numpy.full(3, k.id) for k in files], tmpdir, '.hdf5', num_workers=3)
+            self.assertEqual(written, [k.make_path(tmpdir, '.hdf5') for k in files])
+            for f in files:
+                self.assertEqual(f.load(tmpdir).tolist(), [f.id] * 3)
+
+            # resumes, only computing the missing arrays
+            os.unlink(files[1].make_path(tmpdir, '.hdf5'))
+            computed = []
+            def compute(id):
+                computed.append(id)
+                return numpy.zeros(2)
+            written = db.save_many([k.id for k in files], compute, tmpdir, skip_existing=True)
+            self.assertEqual(computed, [files[1].id])
+            self.assertEqual(written, [files[1].make_path(tmpdir, '.hdf5')])
+            self.assertEqual(files[1].load(tmpdir).tolist(), [0, 0])
+
+            written = db.save_many(files[:2], [numpy.ones(1)] * 2, os.path.join(tmpdir, 'p'), processes=True,
+                                   num_workers=2)
+            self.assertEqual([files[0].load(os.path.join(tmpdir, 'p')).tolist()], [[1.0]])
+            self.assertRaises(ValueError, db.save_many, files, [numpy.ones(1)], tmpdir)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    @db_available
+    def test36_iter_objects(self):
+
+        import itertools
+
+        for backend in Database.backends:
+            db = Database(backend=backend)
+            expected = db.objects(groups=('train', 'dev'), purposes=('genuine', 'spoof'))
+            stream = db.iter_objects(groups=('train', 'dev'), purposes=('genuine', 'spoof'), chunk_size=1500)
+            self.assertEqual(next(stream), expected[0])
+            self.assertEqual([k.id for k in itertools.chain([expected[0]], stream)], [k.id for k in expected])
+            stream = db.iter_objects(groups='train', purposes=('genuine', 'spoof'), chunk_size=4, offset=5, limit=10)
+            self.assertEqual([k.id for k in stream], [k.id for k in expected if k.group == 'train'][5:15])
+            self.assertEqual(list(db.iter_objects(groups='train', offset=len(expected))), [])
+            self.assertEqual(list(db.iter_objects(limit=0)), [])
+
+    @snapshot_available
+    def test37_snapshot_backend(self):
+
+        import pickle
+
+        db = Database()
+        snapshot = Database(backend='snapshot')
+        self.assertTrue(snapshot.m_session is None)
+        for query in (dict(groups='train'), dict(groups=('dev', 'eval'), purposes=('genuine', 'spoof')),
+                      dict(clients='M0001', purposes='spoof')):
+            self.assertEqual(snapshot.objects(**query), db.records(**query))
+        self.assertEqual([tuple(k) for k in snapshot.clients(groups='dev')],
+                         [(k.id, k.gender, k.group) for k in db.clients(groups='dev')])
+        self.assertEqual(snapshot.protocol_names(), db.protocol_names())
+        self.assertEqual(snapshot.protocol('competition').id, db.protocol('competition').id)
+        self.assertTrue(snapshot.has_protocol('competition'))
+        self.assertFalse(snapshot.has_client_id('X0000'))
+        self.assertEqual(snapshot.client('M0001').group, 'train')
+        self.assertRaises(KeyError, snapshot.client, 'X0000')
+
+        paths = ['train/T_1000001', 'dev/D_1000002']
+        self.assertEqual([k.id for k in snapshot.reverse(paths)], [k.id for k in db.reverse(paths)])
+        self.assertRaises(KeyError, snapshot.reverse, paths + ['x'])
+        self.assertEqual(len(snapshot.reverse(paths + ['x'], preserve_order=False)), 2)
+        ids = [k.id for k in snapshot.reverse(paths)]
+        self.assertEqual(snapshot.paths(ids, 'a', '.wav'), db.paths(ids, 'a', '.wav'))
+        self.assertRaises(ValueError, snapshot.explain)
+        self.assertRaises(ValueError, snapshot.query, File)
+        self.assertEqual(db.query(File).count(), 18946)
+
+        copy = pickle.loads(pickle.dumps(snapshot))
+        self.assertTrue(copy.m_session is None)
+        self.assertEqual(copy.objects(groups='dev'), snapshot.objects(groups='dev'))
+
+    def test38_create_update(self):
+
+        import argparse
+        import shutil
+        import tempfile
+        from pkg_resources import resource_filename
+        from bob.db.base.utils import session_try_readonly
+        from .create import create
+
+        def contents(dbfile):
+            s = session_try_readonly('sqlite', dbfile)
+            q = s.query(File.path, File.id, File.purpose, File.client_id, File.environment, Protocol.name). \
+                join(ProtocolFiles, ProtocolFiles.file_id == File.id).join(Protocol)
+            retval = dict((k[0], tuple(k[1:])) for k in q)
+            clients = sorted(k.id for k in s.query(Client))
+            s.close()
+            return retval, clients
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            protodir = os.path.join(tmpdir, 'protocols')
+            shutil.copytree(resource_filename(__name__, 'protocols'), protodir)
+            dbfile = os.path.join(tmpdir, 'db.sql3')
+            args = argparse.Namespace(files=[dbfile], type='sqlite', recreate=False, update=True, verbose=0,
+                                      samplesdir='', protodir=protodir, audiodir=None, workers=8)
+            self.assertEqual(create(args), 0)  # a new database is created in full
+            before, _ = contents(dbfile)
+
+            # the eval labels are released for two files, one is withdrawn
+            evalfile = os.path.join(protodir, 'ASVspoof2017_eval.trl')
+            with open(evalfile) as f:
+                lines = f.readlines()
+            lines[:3] = ['E_1000001.wav genuine M0020 S03 - - -\n', 'E_1000002.wav spoof M0020 S10 E02 P03 R04\n']
+            with open(evalfile, 'w') as f:
+                f.writelines(lines)
+            with open(os.path.join(protodir, 'ASVspoof2017_dev.trl'), 'a') as f:
+                f.write('D_1999999.wav genuine M0011 S01 - - -\n')
+
+            self.assertEqual(create(args), 0)
+            after, clients = contents(dbfile)
+            self.assertEqual(after['eval/E_1000001'][:3], (before['eval/E_1000001'][0], 'genuine', 'M0020'))
+            self.assertEqual(after['eval/E_1000002'][1:4], ('spoof', 'M0020', 'E02'))
+            self.assertFalse('eval/E_1000003' in after)
+            self.assertEqual(after['dev/D_1999999'][4], 'competition')
+            for path in before:
+                if path in after:
+                    self.assertEqual(after[path][0], before[path][0])
+            self.assertTrue('M0020' in clients)
+
+            # the same contents as a database created from scratch, but for the ids
+            args.files = [os.path.join(tmpdir, 'new.sql3')]
+            self.assertEqual(create(args), 0)
+            fresh, fresh_clients = contents(args.files[0])
+            self.assertEqual(dict((k, v[1:]) for k, v in after.items()), dict((k, v[1:]) for k, v in fresh.items()))
+            self.assertEqual(clients, fresh_clients)
+
+            # nothing changed since
+            args.files = [dbfile]
+            self.assertEqual(create(args), 0)
+            self.assertEqual(contents(dbfile)[0], after)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test39_stable_ids(self):
+
+        import argparse
+        import random
+        import shutil
+        import tempfile
+        from pkg_resources import resource_filename
+        from bob.db.base.utils import session_try_readonly
+        from .create import create, stable_id, load_id_map
+
+        def ids(dbfile):
+            s = session_try_readonly('sqlite', dbfile)
+            retval = dict(s.query(File.path, File.id))
+            s.close()
+            return retval
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            args = argparse.Namespace(files=[os.path.join(tmpdir, 'a', 'db.sql3')], type='sqlite', recreate=True,
+                                      update=False, verbose=0, samplesdir='',
+                                      protodir=resource_filename(__name__, 'protocols'), audiodir=None, workers=8)
+            self.assertEqual(create(args), 0)
+            first = ids(args.files[0])
+            self.assertEqual(first['train/T_1000001'], stable_id('train/T_1000001'))
+            self.assertEqual(load_id_map(os.path.join(tmpdir, 'a', 'db.ids')), first)
+
+            # another machine, with the lines of the protocol files in another order
+            protodir = os.path.join(tmpdir, 'protocols')
+            shutil.copytree(args.protodir, protodir)
+            trainfile = os.path.join(protodir, 'ASVspoof2017_train.trn')
+            with open(trainfile) as f:
+                lines = f.readlines()
+            random.Random(0).shuffle(lines)
+            with open(trainfile, 'w') as f:
+                f.writelines(lines)
+            args.files = [os.path.join(tmpdir, 'b', 'db.sql3')]
+            args.protodir = protodir
+            self.assertEqual(create(args), 0)
+            self.assertEqual(ids(args.files[0]), first)
+
+            # ids from the map win over the ones derived from the paths
+            with open(os.path.join(tmpdir, 'b', 'db.ids'), 'a') as f:
+                f.write('train/T_1000001 7\n')
+            self.assertEqual(create(args), 0)
+            self.assertEqual(ids(args.files[0])['train/T_1000001'], 7)
+
+            # a downloaded database has no id map: its ids are kept all the same
+            os.unlink(os.path.join(tmpdir, 'b', 'db.ids'))
+            self.assertEqual(create(args), 0)
+            self.assertEqual(ids(args.files[0])['train/T_1000001'], 7)
+            self.assertEqual(load_id_map(os.path.join(tmpdir, 'b', 'db.ids'))['train/T_1000001'], 7)
+
+            taken = set([stable_id('x')])
+            self.assertNotEqual(stable_id('x', taken), stable_id('x'))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    @db_available
+    def test40_process_safe(self):
+
+        import pickle
+        import threading
+        import multiprocessing
+        from concurrent.futures import ThreadPoolExecutor
+
+        db = Database(process_safe=True)
+        expected = [k.id for k in db.objects(clients='M0001')]
+        self.assertTrue(expected)
+
+        # one session per thread
+        def work(client):
+            return db.m_session, [k.id for k in db.objects(clients=client)]
+        with ThreadPoolExecutor(2) as pool:
+            results = list(pool.map(work, ['M0001'] * 4))
+        self.assertEqual([k[1] for k in results], [expected] * 4)
+        self.assertFalse(any(k[0] is db.m_session for k in results))
+
+        # the state of a thread goes away with it
+        thread = threading.Thread(target=db.objects, kwargs=dict(clients='M0002'))
+        thread.start()
+        thread.join()
+        self.assertEqual(len(db.m_cache), 1)
+        self.assertEqual(ThreadPoolExecutor(1).submit(lambda: len(db.m_cache)).result(), 0)
+
+        # the session is opened again after a fork, even with the lock held by
+        # another thread of the parent
+        def child(queue):
+            ids = [k.id for k in db.objects(clients='M0001')]
+            queue.put((db.m_pid == os.getpid(), ids))
+        held, release = threading.Event(), threading.Event()
+        def hold():
+            with db.m_lock:
+                held.set()
+                release.wait()
+        holder = threading.Thread(target=hold)
+        holder.start()
+        held.wait()
+        try:
+            context = multiprocessing.get_context('fork')
+            queue = context.Queue()
+            process = context.Process(target=child, args=(queue,))
+            process.start()
+            self.assertEqual(queue.get(timeout=60), (True, expected))
+            process.join()
+            self.assertEqual(process.exitcode, 0)
+        finally:
+            release.set()
+            holder.join()
+
+        copy = pickle.loads(pickle.dumps(db))
+        self.assertEqual([k.id for k in copy.objects(clients='M0001')], expected)
+        self.assertRaises(Exception, db.m_session.execute, 'DELETE FROM file')
+
+    @db_available
+    def test41_async_database(self):
+
+        import asyncio
+        import numpy
+        import shutil
+        import tempfile
+        import threading
+        import time
+        from .asyncdb import AsyncDatabase
+
+        async def main(tmpdir):
+            async with AsyncDatabase(max_workers=2, max_concurrency=3, original_directory=tmpdir) as db:
+                files, records = await asyncio.gather(db.objects(clients='M0001'), db.records(clients='M0001'))
+                self.assertEqual([k.id for k in files], [k.id for k in records])
+                self.assertEqual(await db.paths([files[0].id], 'a', '.wav'), [files[0].make_path('a', '.wav')])
+
+                for i, f in enumerate(records[:3]):
+                    write_wav(f.audiofile(tmpdir), numpy.arange(10 * (i + 1)))
+                data = await db.load_audio(records[:3])
+                self.assertEqual([k.shape for k in data], [(1, 10), (1, 20), (1, 30)])
+
+                # all chunks are read on the same thread
+                threads = []
+                def iter_objects(**kwargs):
+                    for k in Database.iter_objects(db.database, **kwargs):
+                        threads.append(threading.current_thread())
+                        yield k
+                db.database.iter_objects = iter_objects
+                streamed = [k.id async for k in db.iter_objects(chunk_size=4, groups='dev', limit=10)]
+                self.assertEqual(streamed, [k.id for k in db.database.objects(groups='dev')][:10])
+                self.assertEqual(len(set(threads)), 1)
+                self.assertFalse(threading.current_thread() in threads)
+
+                # an iteration cancelled while a chunk is read does not wait for it
+                release = threading.Event()
+                def iter_objects(**kwargs):
+                    for i, k in enumerate(Database.iter_objects(db.database, **kwargs)):
+                        if i == 4:
+                            release.wait(5)
+                        yield k
+                db.database.iter_objects = iter_objects
+                async def consume():
+                    return [k async for k in db.iter_objects(chunk_size=4, groups='dev')]
+                task = asyncio.ensure_future(consume())
+                await asyncio.sleep(0.2)
+                start = time.time()
+                task.cancel()
+                with self.assertRaises(asyncio.CancelledError):
+                    await task
+                self.assertTrue(time.time() - start < 2)
+                release.set()
+                return db
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            db = asyncio.run(main(tmpdir))
+            # the sessions of all threads are closed
+            self.assertTrue(db.database.m_sessions)
+            self.assertFalse(any(k.in_transaction() for k in db.database.m_sessions))
+        finally:
+            shutil.rmtree(tmpdir)
+
+        # the same database, from successive event loops
+        db = AsyncDatabase(max_workers=2)
+        for _ in range(2):
+            self.assertTrue(asyncio.run(db.objects(clients='M0001')))
+        db.close()
+
+    @db_available
+    def test42_shards(self):
+
+        import argparse
+        import numpy
+        import shutil
+        import subprocess
+        import sys
+        import tempfile
+        from pkg_resources import resource_filename
+        from . import query
+        from .create import create
+        from .dumplist import shard_spec, balance_choices
+
+        db = Database()
+        everything = db.objects(groups='train', purposes=('genuine', 'spoof'))
+        shards = [db.objects(groups='train', purposes=('genuine', 'spoof'), shard=i, num_shards=3) for i in range(3)]
+        self.assertEqual([k.id for k in sum(shards, [])], [k.id for k in everything])
+        self.assertTrue(all(abs(len(k) - len(everything) / 3.) < 1 for k in shards))
+        self.assertEqual([k.id for k in db.records(groups='train', purposes=('genuine', 'spoof'), shard=1,
+                                                   num_shards=3)], [k.id for k in shards[1]])
+        self.assertRaises(ValueError, db.objects, shard=3, num_shards=3)
+        self.assertRaises(ValueError, db.objects, shard=0, num_shards=2, balance='weight')
+
+        tmpdir = tempfile.mkdtemp()
+        saved = query.SQLITE_FILE
+        try:
+            db = Database(original_directory=tmpdir)
+            files = db.objects(clients='M0001')
+            # a very long file, then short ones
+            lengths = dict((k.id, 100 * (len(files) - 1) if i == 0 else 100) for i, k in enumerate(files))
+            for f in files:
+                write_wav(f.audiofile(tmpdir), numpy.zeros(lengths[f.id]))
+            # durations must be stored, so that shard tasks read no header
+            self.assertRaises(ValueError, db.objects, clients='M0001', shard=0, num_shards=2, balance='duration')
+
+            dbfile = os.path.join(tmpdir, 'db.sql3')
+            args = argparse.Namespace(files=[dbfile], type='sqlite', recreate=True, update=False, verbose=0,
+                                      samplesdir='', protodir=resource_filename(__name__, 'protocols'),
+                                      audiodir=tmpdir, workers=4)
+            self.assertEqual(create(args), 0)
+            query.SQLITE_FILE = dbfile
+            db = Database(original_directory=tmpdir)
+            for balance, weight in (('duration', lambda n: n), ('size', lambda n: 44 + 2 * n)):
+                shards = [db.objects(clients='M0001', shard=i, num_shards=2, balance=balance) for i in range(2)]
+                self.assertEqual(sorted(k.id for k in sum(shards, [])), sorted(lengths))
+                totals = [sum(weight(lengths[f.id]) for f in k) for k in shards]
+                self.assertTrue(abs(totals[0] - totals[1]) <= weight(100))
+            # the long file gets a shard of its own
+            self.assertEqual([k.id for k in db.objects(clients='M0001', shard=0, num_shards=2, balance='duration')],
+                             [files[0].id])
+        finally:
+            query.SQLITE_FILE = saved
+            shutil.rmtree(tmpdir)
+
+        # the parser is built without the query module
+        self.assertEqual(balance_choices, Database.balance_choices)
+        code = ("import sys, argparse; from bob.db.asvspoof2017.dumplist import add_command; "
+                "add_command(argparse.ArgumentParser().add_subparsers()); "
+                "print('bob.db.asvspoof2017.query' in sys.modules)")
+        result = subprocess.run([sys.executable, '-c', code], stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                universal_newlines=True)
+        self.assertEqual(result.stdout.strip(), 'False', result.stderr)
+
+        self.assertEqual(shard_spec('2/5'), (2, 5))
+        self.assertRaises(argparse.ArgumentTypeError, shard_spec, '5/5')
+        self.assertRaises(argparse.ArgumentTypeError, shard_spec, '1')
+
+    @db_available
+    def test43_audio_info(self):
+
+        import argparse
+        import shutil
+        import tempfile
+        import numpy
+        from pkg_resources import resource_filename
+        from bob.db.base.utils import session_try_readonly
+        from . import query
+        from .create import create
+
+        files = Database().objects(clients='M0001')
+        # the last files are the shortest, one is missing
+        lengths = dict((k.path, 1600 * (len(files) - i)) for i, k in enumerate(files[1:]))
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            audiodir = os.path.join(tmpdir, 'audio')
+            for f in files[1:]:
+                write_wav(f.audiofile(audiodir), numpy.zeros(lengths[f.path]))
+            dbfile = os.path.join(tmpdir, 'db.sql3')
+            args = argparse.Namespace(files=[dbfile], type='sqlite', recreate=True, update=False, verbose=0,
+                                      samplesdir='', protodir=resource_filename(__name__, 'protocols'),
+                                      audiodir=audiodir, workers=4)
+            self.assertEqual(create(args), 0)
+
+            s = session_try_readonly('sqlite', dbfile)
+            info = dict((k[0], k[1:]) for k in s.query(File.path, File.rate, File.samples, File.duration).
+                        filter(File.rate != None))
+            s.close()
+            self.assertEqual(sorted(info), sorted(lengths))
+            self.assertEqual(info[files[1].path], (16000, lengths[files[1].path], lengths[files[1].path] / 16000.))
+
+            saved = query.SQLITE_FILE
+            query.SQLITE_FILE = dbfile
+            try:
+                for backend in ('sql', 'columnar'):
+                    db = Database(backend=backend)
+                    self.assertEqual([k.path for k in db.objects(clients='M0001', min_duration=0.5,
+                                                                 max_duration=1.)],
+                                     sorted(k for k in lengths if 0.5 <= lengths[k] / 16000. <= 1.))
+                    self.assertEqual([k.path for k in db.objects(clients='M0001', min_duration=0)],
+                                     [k.path for k in files[1:]])
+                    ordered = db.records(clients='M0001', order_by='duration')
+                    self.assertEqual([k.path for k in ordered], [k.path for k in files[:0:-1]] + [files[0].path])
+                    self.assertRaises(ValueError, db.objects, order_by='size')
+            finally:
+                query.SQLITE_FILE = saved
+        finally:
+            shutil.rmtree(tmpdir)
+
+    @db_available
+    def test44_length_batches(self):
+
+        import argparse
+        import shutil
+        import tempfile
+        import numpy
+        from pkg_resources import resource_filename
+        from . import query
+        from .create import create
+        from .query import length_batches
+
+        lengths = [5, 1, 4, 2, 3, 9, 1, 2]
+        batches = length_batches(lengths, 6, num_buckets=2)
+        self.assertEqual(batches, [[1, 6, 3], [7], [4], [2], [0], [5]])
+        for seed in range(5):
+            batches = length_batches(lengths, 6, num_buckets=2, shuffle=True, seed=seed)
+            self.assertEqual(batches, length_batches(lengths, 6, num_buckets=2, shuffle=True, seed=seed))
+            self.assertEqual(sorted(sum(batches, [])), list(range(len(lengths))))
+            for batch in batches:
+                self.assertTrue(len(batch) == 1 or max(lengths[i] for i in batch) * len(batch) <= 6)
+                # the 4 shortest and the 4 longest are never mixed
+                self.assertEqual(len(set(lengths[i] > 2 for i in batch)), 1)
+        self.assertEqual(length_batches([], 6), [])
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            files = Database().objects(clients='M0001')
+            samples = dict((k.id, 1000 * (1 + i % 7)) for i, k in enumerate(files))
+            audiodir = os.path.join(tmpdir, 'audio')
+            for f in files:
+                write_wav(f.audiofile(audiodir), numpy.zeros(samples[f.id]))
+
+            # lengths are read from the headers, once
+            db = Database(original_directory=audiodir)
+            self.assertEqual(db.lengths(files), [samples[k.id] for k in files])
+            os.unlink(files[0].audiofile(audiodir))
+            self.assertEqual(db.lengths(files[:1]), [samples[files[0].id]])
+            batches = list(db.batches(16000, num_buckets=3, shuffle=True, seed=1, clients='M0001'))
+            self.assertEqual(sorted(k.id for k in sum(batches, [])), sorted(samples))
+            self.assertTrue(all(max(samples[f.id] for f in k) * len(k) <= 16000 for k in batches))
+            self.assertEqual([[f.id for f in k] for k in batches],
+                             [[f.id for f in k] for k in db.batches(16000, num_buckets=3, shuffle=True, seed=1,
+                                                                      clients='M0001')])
+
+            # lengths are stored in the database
+            dbfile = os.path.join(tmpdir, 'db.sql3')
+            args = argparse.Namespace(files=[dbfile], type='sqlite', recreate=True, update=False, verbose=0,
+                                      samplesdir='', protodir=resource_filename(__name__, 'protocols'),
+                                      audiodir=audiodir, workers=4)
+            self.assertEqual(create(args), 0)
+            shutil.rmtree(audiodir)
+            saved = query.SQLITE_FILE
+            query.SQLITE_FILE = dbfile
+            try:
+                for backend in ('sql', 'columnar'):
+                    db = Database(backend=backend)
+                    self.assertEqual(db.lengths(files[1:]), [samples[k.id] for k in files[1:]])
+                    self.assertRaises(IOError, db.lengths, files[:1])
+            finally:
+                query.SQLITE_FILE = saved
+        finally:
+            shutil.rmtree(tmpdir)
+
+    @db_available
+    def test45_balanced_sampler(self):
+
+        import collections
+        from . import BalancedSampler
+
+        db = Database()
+        sampler = BalancedSampler(db, groups=('train', 'dev'), seed=3)
+        files = dict((k.id, k) for k in db.records(groups=('train', 'dev'), purposes=('genuine', 'spoof')))
+        self.assertEqual(len(sampler), len(files))
+        self.assertEqual(sum(sampler.counts), len(files))
+        key = sampler.keys[-1]
+        self.assertEqual(sorted(sampler.ids[sampler.stratum(key)]),
+                         sorted(k.id for k in files.values() if
+                                (k.purpose, k.environment, k.playback_device, k.recording_device) == key))
+
+        # half genuine and half spoof, whatever the number of strata of each
+        genuine = len([k for k in sampler.keys if k[0] == 'genuine'])
+        spoof = len(sampler.keys) - genuine
+        self.assertNotEqual(genuine, spoof)
+        batch = sampler.draw(2 * genuine * spoof + 1)
+        counts = collections.Counter((files[k].purpose, files[k].environment, files[k].playback_device,
+                                      files[k].recording_device) for k in batch.tolist())
+        self.assertEqual(sorted(counts), sampler.keys)
+        self.assertEqual(sorted(counts[k] for k in sampler.keys if k[0] == 'genuine')[:-1], [spoof] * (genuine - 1))
+        self.assertEqual(sorted(counts[k] for k in sampler.keys if k[0] == 'spoof')[:-1], [genuine] * (spoof - 1))
+        purposes = collections.Counter(files[k].purpose for k in batch.tolist())
+        self.assertEqual(sorted(purposes.values()), [genuine * spoof, genuine * spoof + 1])
+
+        again = BalancedSampler(db, groups=('train', 'dev'), seed=3)
+        self.assertEqual(batch.tolist(), again.draw(len(batch)).tolist())
+        for ids, paths in zip(sampler.batches(10, 5), again.batches(10, 5, paths=True)):
+            self.assertEqual(db.make_paths(ids), paths.tolist())
+
+        sampler = BalancedSampler(db, strata=('purpose',), groups='train')
+        batch = sampler.draw(1000)
+        self.assertEqual(collections.Counter(files[k].purpose for k in batch.tolist()),
+                         {'genuine': 500, 'spoof': 500})
+        self.assertRaises(ValueError, BalancedSampler, db, clients='nobody')
+
+    def test46_reload_on_change(self):
+
+        import argparse
+        import shutil
+        import tempfile
+        from pkg_resources import resource_filename
+        from . import query
+        from .create import create
+
+        tmpdir = tempfile.mkdtemp()
+        saved = query.SQLITE_FILE
+        try:
+            protodir = os.path.join(tmpdir, 'protocols')
+            shutil.copytree(resource_filename(__name__, 'protocols'), protodir)
+            dbfile = os.path.join(tmpdir, 'db.sql3')
+            args = argparse.Namespace(files=[dbfile], type='sqlite', recreate=True, update=False, verbose=0,
+                                      samplesdir='', protodir=protodir, audiodir=None, workers=8)
+            self.assertEqual(create(args), 0)
+
+            query.SQLITE_FILE = dbfile
+            dbs = [Database(backend=k) for k in Database.backends]
+            before = [len(db.objects(groups='dev')) for db in dbs]
+
+            # the database is created again, with one more file
+            with open(os.path.join(protodir, 'ASVspoof2017_dev.trl'), 'a') as f:
+                f.write('D_1999999.wav genuine M0011 S01 - - -\n')
+            self.assertEqual(create(args), 0)
+            for k in (dbfile, os.path.join(tmpdir, 'db.npz')):
+                os.utime(k, (0, os.path.getmtime(k) + 10))
+
+            for db, count in zip(dbs, before):
+                self.assertEqual(len(db.objects(groups='dev')), count + 1)
+                self.assertEqual(db.objects(groups='dev')[-1].path, 'dev/D_1999999')
+        finally:
+            query.SQLITE_FILE = saved
+            shutil.rmtree(tmpdir)
+
+    @db_available
+    def test47_checkfiles_verify_status(self):
+
+        import argparse
+        from .checkfiles import add_command
+
+        parser = argparse.ArgumentParser()
+        add_command(parser.add_subparsers())
+        args = parser.parse_args('checkfiles --verify --client=M0001 --directory=/nonexistent --self-test'.split())
+        # the files are not installed: the verification fails
+        self.assertEqual(args.func(args), 1)
+
+    def test48_update_per_protocol_file(self):
+
+        import argparse
+        import shutil
+        import tempfile
+        from pkg_resources import resource_filename
+        from bob.db.base.utils import session_try_readonly
+        from .create import create
+
+        def contents(dbfile):
+            s = session_try_readonly('sqlite', dbfile)
+            paths = set(k[0] for k in s.query(File.path).filter(File.group == 'dev'))
+            sources = sorted((k.filename, k.group) for k in s.query(Source))
+            s.close()
+            return paths, sources
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            # the dev files are listed in two protocol files
+            protodir = os.path.join(tmpdir, 'protocols')
+            shutil.copytree(resource_filename(__name__, 'protocols'), protodir)
+            devfile = os.path.join(protodir, 'ASVspoof2017_dev.trl')
+            with open(devfile) as f:
+                lines = f.readlines()
+            with open(devfile, 'w') as f:
+                f.writelines(lines[100:])
+            with open(os.path.join(protodir, 'ASVspoof2017_dev_extra.trl'), 'w') as f:
+                f.writelines(lines[:100])
+            dbfile = os.path.join(tmpdir, 'db.sql3')
+            args = argparse.Namespace(files=[dbfile], type='sqlite', recreate=False, update=True, verbose=0,
+                                      samplesdir='', protodir=protodir, audiodir=None, workers=8)
+            self.assertEqual(create(args), 0)
+            paths, _ = contents(dbfile)
+            self.assertEqual(len(paths), len(lines))
+
+            # the files of the unchanged protocol file are kept
+            with open(devfile, 'a') as f:
+                f.write('D_1999999.wav genuine M0011 S01 - - -\n')
+            self.assertEqual(create(args), 0)
+            self.assertEqual(contents(dbfile)[0], paths | set(['dev/D_1999999']))
+
+            # only removing a protocol file
+            os.unlink(os.path.join(protodir, 'ASVspoof2017_dev_extra.trl'))
+            self.assertEqual(create(args), 0)
+            paths, sources = contents(dbfile)
+            self.assertEqual(len(paths), len(lines) - 100 + 1)
+            self.assertEqual([k[0] for k in sources],
+                             ['ASVspoof2017_dev.trl', 'ASVspoof2017_eval.trl', 'ASVspoof2017_train.trn'])
+            self.assertEqual(create(args), 0)
+            self.assertEqual(contents(dbfile)[1], sources)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test49_migrate_old_schema(self):
+
+        import argparse
+        import shutil
+        import sqlite3
+        import tempfile
+        from pkg_resources import resource_filename
+        from . import query
+        from .create import create
+
+        tmpdir = tempfile.mkdtemp()
+        saved = query.SQLITE_FILE
+        try:
+            protodir = os.path.join(tmpdir, 'protocols')
+            shutil.copytree(resource_filename(__name__, 'protocols'), protodir)
+            dbfile = os.path.join(tmpdir, 'db.sql3')
+            args = argparse.Namespace(files=[dbfile], type='sqlite', recreate=False, update=False, verbose=0,
+                                      samplesdir='', protodir=protodir, audiodir=None, workers=8)
+            self.assertEqual(create(args), 0)
+
+            # the schema of the databases created before the protocol files
+            # and the audio headers were recorded
+            connection = sqlite3.connect(dbfile)
+            connection.execute('DROP TABLE source')
+            for column in ('source', 'rate', 'samples', 'duration'):
+                connection.execute('ALTER TABLE file DROP COLUMN %s' % column)
+            connection.commit()
+            connection.close()
+
+            query.SQLITE_FILE = dbfile
+            for backend in ('sql', 'columnar'):
+                db = Database(backend=backend)
+                self.assertFalse(db.is_valid())
+                with self.assertRaises(IOError) as context:
+                    db.objects()
+                self.assertTrue('file.source' in str(context.exception))
+                self.assertTrue('file.duration' in str(context.exception))
+                self.assertTrue('create --recreate' in str(context.exception))
+
+            # a file is withdrawn before the migration
+            devfile = os.path.join(protodir, 'ASVspoof2017_dev.trl')
+            with open(devfile) as f:
+                lines = f.readlines()
+            with open(devfile, 'w') as f:
+                f.writelines(lines[1:])
+            # the headers of the existing files are read as well
+            import numpy
+            audiodir = os.path.join(tmpdir, 'audio')
+            paths = ['dev/' + os.path.splitext(k.split()[0])[0] for k in lines[1:3]]
+            for i, path in enumerate(paths):
+                write_wav(os.path.join(audiodir, path + '.wav'), numpy.zeros(1600 * (i + 1)))
+            args.update = True
+            args.audiodir = audiodir
+            self.assertEqual(create(args), 0)
+
+            db = Database()
+            self.assertTrue(db.is_valid())
+            self.assertEqual(len(db.objects(groups='dev', purposes=('genuine', 'spoof'))), len(lines) - 1)
+            self.assertEqual(db.query(File).filter(File.source == None).count(), 0)
+            self.assertEqual([k.duration for k in db.reverse(paths)], [0.1, 0.2])
+            self.assertEqual(db.query(File).filter(File.duration != None).count(), 2)
+            self.assertEqual(sorted(k.filename for k in db.query(Source)),
+                             ['ASVspoof2017_dev.trl', 'ASVspoof2017_eval.trl', 'ASVspoof2017_train.trn'])
+        finally:
+            query.SQLITE_FILE = saved
+            shutil.rmtree(tmpdir)
+
+    @db_available
+    def test50_snapshot_without_file(self):
+
+        import shutil
+        import tempfile
+        from . import query
+
+        tmpdir = tempfile.mkdtemp()
+        saved = query.SQLITE_FILE
+        try:
+            # as downloaded: the database file only
+            shutil.copy(query.SQLITE_FILE, os.path.join(tmpdir, 'db.sql3'))
+            query.SQLITE_FILE = os.path.join(tmpdir, 'db.sql3')
+            snapshot = Database(backend='snapshot')
+            self.assertTrue(snapshot.is_valid())
+            self.assertTrue(snapshot.m_session is None)
+            self.assertFalse(os.path.exists(os.path.join(tmpdir, 'db.npz')))
+            self.assertEqual(snapshot.objects(groups='dev'), Database().records(groups='dev'))
+        finally:
+            query.SQLITE_FILE = saved
+            shutil.rmtree(tmpdir)
+
+    def test51_wav_sample_formats(self):
+
+        import shutil
+        import tempfile
+        import wave
+        from .audio import wav_info, read_wav
+        from .checkfiles import verify_file
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            for bits in (8, 16, 24, 32):
+                path = os.path.join(tmpdir, '%d.wav' % bits)
+                w = wave.open(path, 'wb')
+                w.setnchannels(1)
+                w.setsampwidth(bits // 8)
+                w.setframerate(16000)
+                w.writeframes(b'\0' * (bits // 8) * 10)
+                w.close()
+                if bits == 24:
+                    # no NumPy type holds 24 bit samples
+                    self.assertRaises(ValueError, wav_info, path)
+                    self.assertEqual(verify_file(path)[3], 'corrupt')
+                else:
+                    self.assertEqual(read_wav(path).shape, (1, 10))
+                    self.assertEqual(verify_file(path)[3], 'ok')
+        finally:
+            shutil.rmtree(tmpdir)